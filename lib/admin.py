@@ -36,6 +36,7 @@ import pickle
 import socket
 import sys
 import termios
+import time
 
 from telnetlib import BINARY, ECHO, SGA
 
@@ -48,6 +49,7 @@ Q_VERS        = 2
 Q_NAME        = 'name'
 Q_UUID        = 'uuid'
 Q_PORT        = 'port'
+Q_SLOW_CLIENTS = 'slow_clients'
 Q_OK          = 'vm_found'
 Q_VM_NOTFOUND = 'vm_not_found'
 # Exclusive write and read access; no other clients have any access to the VM.
@@ -61,9 +63,61 @@ Q_LOCK_FFA    = "free_for_all"
 Q_LOCK_FFAR   = "free_for_all_or_readonly"
 Q_LOCK_BAD    = "lock_invalid"
 Q_LOCK_FAILED = "lock_failed"
+# Asked for instead of a lock mode, along with no VM, to get the
+# server's metrics (see vSPC.metrics) rather than a VM. Servers that
+# don't know it answer with Q_VM_NOTFOUND and the VM listing.
+Q_METRICS     = "metrics"
+# Likewise, followed by a number of seconds, to profile the server for
+# that long (see vSPC.sampler)
+Q_PROFILE     = "profile"
+Q_PROFILE_BUSY = "profile_busy"
 
 CLIENT_ESCAPE_CHAR = chr(29)
 
+def server_query(host, admin_port, query, *args):
+    """
+    Ask the vSPC server at host for query, one of the queries about the
+    server rather than a VM, followed by args. Return the status it
+    answers with, and what came with it if that is Q_OK. Servers that
+    don't know the query answer with Q_VM_NOTFOUND.
+    """
+    s = socket.create_connection((host, admin_port))
+    try:
+        sockfile = s.makefile()
+        unpickler = pickle.Unpickler(sockfile)
+
+        pickle.dump(Q_VERS, sockfile)
+        sockfile.flush()
+        if int(unpickler.load()) < 2:
+            return (Q_VM_NOTFOUND, None)
+        pickle.dump(None, sockfile)
+        pickle.dump(query, sockfile)
+        for arg in args:
+            pickle.dump(arg, sockfile)
+        sockfile.flush()
+        status = unpickler.load()
+        if status != Q_OK:
+            return (status, None)
+        return (status, unpickler.load())
+    finally:
+        s.close()
+
+def query_metrics(host, admin_port):
+    """
+    Return the metrics of the vSPC server at host, as returned by
+    vSPC.metrics.Metrics.collect, or None if the server doesn't keep
+    any.
+    """
+    return server_query(host, admin_port, Q_METRICS)[1]
+
+def query_profile(host, admin_port, seconds):
+    """
+    Profile the vSPC server at host for seconds. Return the status it
+    answers with, and the profile, in the collapsed stack format, if
+    that is Q_OK.
+    """
+    return server_query(host, admin_port, Q_PROFILE, seconds)
+
 class AdminProtocolClient(Poller):
     def __init__(self, host, admin_port, vm_name, src, dst, lock_mode):
         Poller.__init__(self)
@@ -227,6 +281,9 @@ class AdminProtocolClient(Poller):
             if vm[Q_PORT] is not None:
                 out += ":%d" % vm[Q_PORT]
             print out
+            # (time, client, action) for clients that couldn't keep up
+            for (when, client, action) in vm.get(Q_SLOW_CLIENTS, ()):
+                print "  slow client %s at %s: %s" % (client, time.ctime(when), action)
 
     def prepare_terminal(self):
         (oldterm, oldflags) = prepare_terminal(self.command_source)
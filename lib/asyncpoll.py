@@ -0,0 +1,171 @@
+# vSPC/asyncpoll.py -- Poller implementation on top of an asyncio event loop
+
+import thread
+
+try:
+    import asyncio
+except ImportError:
+    # asyncio backport for Python 2
+    import trollius as asyncio
+
+from poll import Poller
+
+class AsyncioTimer:
+    """
+    Handle for a callback scheduled with AsyncioPoller.call_later.
+    """
+    def __init__(self):
+        self.handle    = None
+        self.cancelled = False
+
+class AsyncioPoller(Poller):
+    """
+    A Poller whose streams are watched by an asyncio event loop instead
+    of by Poller's own epoll object.
+
+    It provides the same add_reader/add_writer/del_all/delete_stream/
+    call_later/run_forever surface, so code written against Poller runs
+    on it unchanged (see on_asyncio). Handlers and timers run on the
+    loop's thread. The other methods may be called from any thread, as
+    with Poller; calls from other threads are handed to the loop with
+    call_soon_threadsafe.
+
+    One-shot registration (Poller's edge_triggered mode) isn't available
+    here; readers added with oneshot=True are ordinary readers. The loop
+    keeps no counters like those of Poller.poll_stats, so only the
+    number of streams watched is added to metrics.
+    """
+    def setup_epoll(self):
+        # The loop polls for us
+        pass
+
+    def setup_loop(self, loop = None):
+        self.loop = loop or asyncio.get_event_loop()
+        # Thread id of the thread running the loop, once it runs
+        self.loop_thread = None
+        # fileno => stream, for the streams the loop is watching
+        self.loop_streams = {}
+
+    def _call(self, func, *args):
+        """
+        Call func on the loop's thread: right away if we're on it, or
+        if the loop isn't running yet.
+        """
+        if self.loop_thread is None or self.loop_thread == thread.get_ident():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def add_reader(self, stream, func, oneshot = False):
+        self._call(self._add_reader, stream, func)
+
+    def _add_reader(self, stream, func):
+        self.loop_streams[stream.fileno()] = stream
+        self.loop.add_reader(stream.fileno(), func, stream)
+
+    def del_reader(self, stream):
+        self._call(self._del_reader, stream)
+
+    def _del_reader(self, stream):
+        try:
+            self.loop.remove_reader(stream.fileno())
+        except (ValueError, IOError, OSError):
+            # Already closed
+            pass
+
+    def add_writer(self, stream, func):
+        self._call(self._add_writer, stream, func)
+
+    def _add_writer(self, stream, func):
+        self.loop_streams[stream.fileno()] = stream
+        self.loop.add_writer(stream.fileno(), func, stream)
+
+    def del_writer(self, stream):
+        self._call(self._del_writer, stream)
+
+    def _del_writer(self, stream):
+        try:
+            self.loop.remove_writer(stream.fileno())
+        except (ValueError, IOError, OSError):
+            pass
+
+    def del_all(self, stream):
+        self.del_reader(stream)
+        self.del_writer(stream)
+
+    def delete_stream(self, stream):
+        # The stream may be closed before the loop gets to this, so
+        # look it up by identity rather than by fileno.
+        self._call(self._delete_stream, stream)
+
+    def _delete_stream(self, stream):
+        for fileno, s in self.loop_streams.items():
+            if s is stream:
+                del self.loop_streams[fileno]
+                try:
+                    self.loop.remove_reader(fileno)
+                    self.loop.remove_writer(fileno)
+                except (ValueError, IOError, OSError):
+                    pass
+
+    def call_later(self, delay, func):
+        timer = AsyncioTimer()
+        self._call(self._call_later, timer, delay, func)
+        return timer
+
+    def _call_later(self, timer, delay, func):
+        if not timer.cancelled:
+            timer.handle = self.loop.call_later(max(delay, 0), func)
+
+    def cancel(self, timer):
+        timer.cancelled = True
+        self._call(self._cancel, timer)
+
+    def _cancel(self, timer):
+        if timer.handle is not None:
+            timer.handle.cancel()
+
+    def register_poll_metrics(self, metrics):
+        metrics.gauge('vspc_poll_streams', 'Streams being polled',
+                      lambda: len(self.loop_streams))
+
+    def run_once(self, timeout = -1):
+        """
+        Run a single, non-blocking pass of the event loop.
+        """
+        self.loop.stop()
+        self.run_forever()
+
+    def run_forever(self):
+        """
+        Run the event loop. If it is already running, i.e. we're
+        embedded in an asyncio application, just return: our handlers
+        are registered with the loop and will be called from it.
+        """
+        if self.loop.is_running():
+            # We may not be on the loop's thread; hand everything to the
+            # loop until we find out which thread that is.
+            self.loop_thread = -1
+            self.loop.call_soon_threadsafe(self._note_loop_thread)
+            return
+        self.loop_thread = thread.get_ident()
+        self.loop.run_forever()
+
+    def _note_loop_thread(self):
+        self.loop_thread = thread.get_ident()
+
+def on_asyncio(cls):
+    """
+    Return a variant of cls, a Poller subclass such as vSPC,
+    AdminProtocolClient or FakeVMClient, that runs on an asyncio event
+    loop. Its constructor takes the same arguments as cls's, plus an
+    optional loop keyword argument (default: the current event loop).
+    """
+    class AsyncioVariant(AsyncioPoller, cls):
+        def __init__(self, *args, **kwargs):
+            loop = kwargs.pop('loop', None)
+            cls.__init__(self, *args, **kwargs)
+            self.setup_loop(loop)
+
+    AsyncioVariant.__name__ = 'Asyncio' + cls.__name__
+    return AsyncioVariant
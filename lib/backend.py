@@ -39,26 +39,55 @@ import signal
 import string
 import sys
 import threading
+import time
 import Queue
 
-from admin import Q_VERS, Q_NAME, Q_UUID, Q_PORT, Q_OK, Q_VM_NOTFOUND, Q_LOCK_EXCL, Q_LOCK_WRITE, Q_LOCK_FFA, Q_LOCK_FFAR, Q_LOCK_BAD, Q_LOCK_FAILED
+from admin import Q_VERS, Q_NAME, Q_UUID, Q_PORT, Q_SLOW_CLIENTS, Q_OK, Q_VM_NOTFOUND, Q_LOCK_EXCL, Q_LOCK_WRITE, Q_LOCK_FFA, Q_LOCK_FFAR, Q_LOCK_BAD, Q_LOCK_FAILED, Q_METRICS, Q_PROFILE, Q_PROFILE_BUSY
+from metrics import COUNTER
+from sampler import sample, busy, format_collapsed
 
 class vSPCBackendMemory:
     ADMIN_THREADS = 4
     ADMIN_CONN_TIMEOUT = 0.2
+    # Whether the backend can run in each of several vSPC worker
+    # processes (vSPCServer --workers) at once.
+    SUPPORTS_WORKERS = True
+    # How many slow client events to remember for each VM
+    SLOW_CLIENT_HISTORY = 10
+
+    class OVm(object):
+        __slots__ = ('uuid', 'port', 'name', 'modification_lock', 'writers', 'readers',
+                     'lockholder', 'lock_mode', 'lock', 'slow_clients')
 
-    class OVm:
         def __init__(self, uuid = None, port = None, name = None):
             self.uuid = uuid
             self.port = port
             self.name = name
 
-            self.modification_lock = threading.Lock()
-            self.writers = []
-            self.readers = []
+            # Few VMs are ever locked; the locks and lists are made by
+            # setup_locking when a client first asks to
+            self.modification_lock = None
+            self.writers = None
+            self.readers = None
             self.lockholder = None
             self.lock_mode = None
-            self.lock = threading.Lock()
+            self.lock = None
+            # (time, client, action) for the latest clients that
+            # couldn't keep up with the VM's output
+            self.slow_clients = ()
+
+        def setup_locking(self):
+            """
+            Make the VM ready to be locked, if it isn't yet. Callers hold
+            the backend's observed_vms_lock.
+            """
+            if self.modification_lock is None:
+                self.writers = []
+                self.readers = []
+                self.lock = threading.Lock()
+                # Last: client_del looks at modification_lock without
+                # observed_vms_lock, and uses the rest once it's set
+                self.modification_lock = threading.Lock()
 
     def __init__(self):
         self.admin_queue = Queue.Queue()
@@ -68,16 +97,36 @@ class vSPCBackendMemory:
         self.observed_vms_lock = threading.Lock()
         self.observed_vms = {}
         self.observed_vms_loaded = False
+        # uuid => OVm, for VMs served by other vSPC worker processes.
+        # Protected by observed_vms_lock.
+        self.remote_vms = {}
 
         self.hook_queue = Queue.Queue()
 
+        # Admin queries answered
+        self.queries = 0
+
+    def register_metrics(self, metrics):
+        """
+        Add the depths of the backend's queues, and the number of admin
+        queries answered, to metrics, a vSPC.metrics.Metrics.
+        """
+        for (name, queue) in (('admin', self.admin_queue), ('observer', self.observer_queue),
+                              ('hook', self.hook_queue)):
+            metrics.gauge('vspc_backend_%s_queue_depth' % name,
+                          'Work waiting for the backend %s threads' % name, queue.qsize)
+        metrics.gauge('vspc_backend_observed_vms', 'VMs the backend knows of in this process',
+                      lambda: len(self.observed_vms))
+        metrics.family('vspc_admin_queries_total', COUNTER, 'Admin queries answered',
+                       lambda: [('', (), self.queries)])
+
     def setup(self, args):
         if args != '':
             print "%s takes no arguments" % str(self.__class__)
             sys.exit(1)
 
-    def _start_thread(self, f):
-        th = threading.Thread(target = f)
+    def _start_thread(self, f, name):
+        th = threading.Thread(target = f, name = name)
         th.daemon = True
         th.start()
 
@@ -85,10 +134,10 @@ class vSPCBackendMemory:
 
     def start(self):
         for i in range(0, self.ADMIN_THREADS):
-            self.admin_threads.append(self._start_thread(self.admin_run))
+            self.admin_threads.append(self._start_thread(self.admin_run, 'backend admin'))
 
-        self.observer_thread = self._start_thread(self.observer_run)
-        self.hook_thread = self._start_thread(self.hook_run)
+        self.observer_thread = self._start_thread(self.observer_run, 'backend observer')
+        self.hook_thread = self._start_thread(self.hook_run, 'backend hook')
 
     def _queue_run(self, queue):
         while True:
@@ -130,6 +179,34 @@ class vSPCBackendMemory:
 
         return vms.values()
 
+    def get_fleet_vms(self):
+        """
+        Return the VMs known to every vSPC worker process, not just this
+        one.
+        """
+        vms = self.get_observed_vms()
+        with self.observed_vms_lock:
+            fleet = self.remote_vms.copy()
+        for vm in vms:
+            fleet[vm.uuid] = vm
+
+        return fleet.values()
+
+    def notify_remote_vm(self, uuid, name, port):
+        self.observer_queue.put(lambda: self.remote_vm(uuid, name, port))
+
+    def remote_vm(self, uuid, name, port):
+        with self.observed_vms_lock:
+            self.remote_vms[uuid] = self.OVm(uuid = uuid, port = port, name = name)
+
+    def notify_remote_vm_del(self, uuid):
+        self.observer_queue.put(lambda: self.remote_vm_del(uuid))
+
+    def remote_vm_del(self, uuid):
+        with self.observed_vms_lock:
+            if self.remote_vms.has_key(uuid):
+                del self.remote_vms[uuid]
+
     def notify_vm(self, uuid, name, port):
         self.observer_queue.put(lambda: self.vm(uuid, name, port))
 
@@ -144,25 +221,36 @@ class vSPCBackendMemory:
         self.hook_queue.put(lambda: self.vm_hook(*data))
 
     def vm_hook(self, uuid, name, port):
-        logging.debug("vm_hook: uuid: %s, name: %s, port: %s" %
-                      (uuid, name, port))
+        logging.debug("vm_hook: uuid: %s, name: %s, port: %s", uuid, name, port)
 
     def notify_vm_msg(self, uuid, name, s):
         self.hook_queue.put(lambda: self.vm_msg_hook(uuid, name, s))
 
     def vm_msg_hook(self, uuid, name, s):
-        logging.debug("vm_msg_hook: uuid: %s, name: %s, msg: %s" %
-                      (uuid, name, s))
+        logging.debug("vm_msg_hook: uuid: %s, name: %s, msg: %s", uuid, name, s)
+
+    def notify_slow_client(self, uuid, client, action):
+        self.observer_queue.put(lambda: self.slow_client(uuid, client, action))
+
+    def slow_client(self, uuid, client, action):
+        logging.debug("slow_client: uuid %s, client %s, action %s", uuid, client, action)
+        with self.observed_vms_lock:
+            vm = self.observed_vms.get(uuid)
+            if vm is not None:
+                if not vm.slow_clients:
+                    vm.slow_clients = []
+                vm.slow_clients.append((time.time(), client, action))
+                del vm.slow_clients[:-self.SLOW_CLIENT_HISTORY]
 
     def notify_client_del(self, sock, uuid):
         self.hook_queue.put(lambda: self.client_del(sock, uuid))
 
     def client_del(self, sock, uuid):
-        logging.debug("client_del: uuid %s, client %s" % (uuid, sock))
+        logging.debug("client_del: uuid %s, client %s", uuid, sock)
         vm = None
         with self.observed_vms_lock:
             if uuid in self.observed_vms: vm = self.observed_vms[uuid]
-        if vm is not None:
+        if vm is not None and vm.modification_lock is not None:
             with vm.modification_lock:
                 self.maybe_unlock_vm(vm, sock.fileno())
 
@@ -177,11 +265,28 @@ class vSPCBackendMemory:
         self.hook_queue.put(lambda: self.vm_del_hook(uuid))
 
     def vm_del_hook(self, uuid):
-        logging.debug("vm_del_hook: uuid: %s" % uuid)
+        logging.debug("vm_del_hook: uuid: %s", uuid)
 
     def notify_query_socket(self, sock, vspc):
         self.admin_queue.put(lambda: self.handle_query_socket(sock, vspc))
 
+    def notify_query_forwarded(self, sock, vspc, vm_name, lock_mode):
+        self.admin_queue.put(lambda: self.handle_forwarded_query(sock, vspc, vm_name, lock_mode))
+
+    def handle_forwarded_query(self, sock, vspc, vm_name, lock_mode):
+        """
+        Finish a version 2 query that another vSPC worker process read
+        from sock, but handed to us because we serve the VM it names.
+        """
+        sock.settimeout(self.ADMIN_CONN_TIMEOUT)
+        sockfile = sock.makefile()
+
+        try:
+            self.handle_vm_query(sock, sockfile, vspc, vm_name, lock_mode)
+            sockfile.flush()
+        except Exception, e:
+            logging.debug('handle_forwarded_query exception: %s', e)
+
     def handle_query_socket(self, sock, vspc):
         sock.settimeout(self.ADMIN_CONN_TIMEOUT)
         sockfile = sock.makefile()
@@ -203,57 +308,107 @@ class vSPCBackendMemory:
 
         vers = min(Q_VERS, client_vers)
         logging.debug("version %d query", vers)
+        self.queries += 1
 
         try:
             if vers == 2:
                 vm_name = pickle.load(sockfile)
                 lock_mode = pickle.load(sockfile)
-                vm = self.observed_vm_for_name(vm_name)
-
-                if vm is not None and \
-                   lock_mode in (Q_LOCK_EXCL, Q_LOCK_WRITE, Q_LOCK_FFA, Q_LOCK_FFAR):
-                    status = Q_LOCK_FAILED
-                    with vm.modification_lock:
-                        lock_result = self.try_to_lock_vm(vm, sock.fileno(), lock_mode)
-                        if lock_result: status = Q_OK
-                elif vm is None:
-                    status = Q_VM_NOTFOUND
+                if lock_mode == Q_METRICS:
+                    pickle.dump(Q_OK, sockfile)
+                    pickle.dump(vspc.metrics.collect(), sockfile)
+                elif lock_mode == Q_PROFILE:
+                    # Answered from a thread of its own
+                    self.handle_profile_query(sockfile)
+                    return
                 else:
-                    status = Q_LOCK_BAD
-                pickle.dump(status, sockfile)
-
-                if status == Q_OK:
-                    pickle.dump(lock_result, sockfile)
-                    pickle.dump(self.get_seed_data(vm.uuid), sockfile)
-                    sockfile.flush()
-                    readonly = False
-                    if lock_result == Q_LOCK_FFAR:
-                        readonly = True
-                    vspc.queue_new_admin_client_connection(sock, vm.uuid, readonly)
-                elif status == Q_VM_NOTFOUND:
-                    pickle.dump(self.format_vm_listing(), sockfile)
-                else: # unknown lock mode, or lock acquisition failed
-                    pass
+                    self.handle_vm_query(sock, sockfile, vspc, vm_name, lock_mode)
             elif vers == 1:
                 pickle.dump((vers, self.format_vm_listing()), sockfile)
             else:
                 pickle.dump(Exception('No common version'), sockfile)
             sockfile.flush()
         except Exception, e:
-            logging.debug('handle_query_socket exception: %s' % str(e))
+            logging.debug('handle_query_socket exception: %s', e)
+
+    def handle_profile_query(self, sockfile):
+        """
+        Profile the process for as many seconds as the client asks, and
+        send it the profile. The profile is taken by a thread of its
+        own, rather than tying up an admin thread meanwhile; a client
+        asking while one is being taken is turned away right away.
+        """
+        seconds = float(pickle.load(sockfile))
+        if busy():
+            logging.info('not profiling, a profile is being taken already')
+            pickle.dump(Q_PROFILE_BUSY, sockfile)
+            sockfile.flush()
+            return
+        self._start_thread(lambda: self.send_profile(sockfile, seconds), 'profiler')
+
+    def send_profile(self, sockfile, seconds):
+        logging.info('profiling for %gs for an admin query', seconds)
+        try:
+            counts = sample(seconds)
+            if counts is None:
+                # Another profile started meanwhile
+                logging.info('not profiling, a profile is being taken already')
+                pickle.dump(Q_PROFILE_BUSY, sockfile)
+            else:
+                pickle.dump(Q_OK, sockfile)
+                pickle.dump(format_collapsed(counts), sockfile)
+            sockfile.flush()
+        except Exception, e:
+            logging.debug('send_profile exception: %s', e)
+
+    def handle_vm_query(self, sock, sockfile, vspc, vm_name, lock_mode):
+        vm = self.observed_vm_for_name(vm_name)
+
+        if vm is not None and not vspc.owns_vm(vm.uuid):
+            # Another worker process serves this VM, and keeps its locks
+            vspc.forward_admin_query(sock, vm.uuid, vm_name, lock_mode)
+            return
+
+        if vm is not None and \
+           lock_mode in (Q_LOCK_EXCL, Q_LOCK_WRITE, Q_LOCK_FFA, Q_LOCK_FFAR):
+            status = Q_LOCK_FAILED
+            with self.observed_vms_lock:
+                vm.setup_locking()
+            with vm.modification_lock:
+                lock_result = self.try_to_lock_vm(vm, sock.fileno(), lock_mode)
+                if lock_result: status = Q_OK
+        elif vm is None:
+            status = Q_VM_NOTFOUND
+        else:
+            status = Q_LOCK_BAD
+        pickle.dump(status, sockfile)
+
+        if status == Q_OK:
+            pickle.dump(lock_result, sockfile)
+            pickle.dump(self.get_seed_data(vm.uuid), sockfile)
+            sockfile.flush()
+            readonly = False
+            if lock_result == Q_LOCK_FFAR:
+                readonly = True
+            vspc.queue_new_admin_client_connection(sock, vm.uuid, readonly)
+        elif status == Q_VM_NOTFOUND:
+            pickle.dump(self.format_vm_listing(), sockfile)
+        else: # unknown lock mode, or lock acquisition failed
+            pass
 
     def format_vm_listing(self):
-        vms = self.get_observed_vms()
+        vms = self.get_fleet_vms()
 
         l = []
         for vm in vms:
-            l.append({Q_NAME: vm.name, Q_UUID: vm.uuid, Q_PORT: vm.port})
+            l.append({Q_NAME: vm.name, Q_UUID: vm.uuid, Q_PORT: vm.port,
+                      Q_SLOW_CLIENTS: list(vm.slow_clients)})
         return l
 
     def observed_vm_for_name(self, name):
         if name is None: return None
 
-        vms = self.get_observed_vms()
+        vms = self.get_fleet_vms()
         for vm in vms:
             if vm.name == name or vm.uuid == name:
                 return vm
@@ -282,7 +437,7 @@ class vSPCBackendMemory:
 
         Callers are assumed to hold the modification lock of the vm argument.
         """
-        logging.debug("Trying to lock vm %s for client" % vm.name)
+        logging.debug("Trying to lock vm %s for client", vm.name)
         if lock_mode == Q_LOCK_EXCL:
             logging.debug("Exclusive lock mode selected")
             if vm.lock.acquire(False):
@@ -338,6 +493,9 @@ P_NAME = 'name'
 P_PORT = 'port'
 
 class vSPCBackendFile(vSPCBackendMemory):
+    # Several processes writing the same shelf would corrupt it
+    SUPPORTS_WORKERS = False
+
     def __init__(self):
         vSPCBackendMemory.__init__(self)
 
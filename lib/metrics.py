@@ -0,0 +1,240 @@
+# vSPC/metrics.py -- counters, gauges and histograms describing a running vSPC
+
+"""
+A Metrics registry holds the counters and histograms the server updates
+as it goes, and knows how to read everything else worth reporting
+(queue depths, per-VM byte counts and the like) when it is collected.
+Collected metrics are served by the admin port (see vSPCClient
+--metrics) and, optionally, in the Prometheus text format over HTTP, by
+a thread of their own.
+"""
+
+import bisect
+import errno
+import logging
+import socket
+import threading
+import time
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# What Prometheus expects the text format to be served as
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds a scraper may take to send each part of its request, and all
+# of it; requests are answered one at a time
+HTTP_TIMEOUT = 2.0
+HTTP_DEADLINE = 5.0
+# Longest request we read
+HTTP_MAX_REQUEST = 8192
+
+class Histogram(object):
+    """
+    A histogram kept in a Metrics registry's values: a count for each
+    of bounds, one for larger values, and the sum of everything
+    observed.
+    """
+    __slots__ = ('values', 'index', 'bounds', 'sum_index')
+
+    def __init__(self, values, index, bounds):
+        self.values = values
+        self.index = index
+        self.bounds = bounds
+        self.sum_index = index + len(bounds) + 1
+
+    def observe(self, v):
+        self.values[self.index + bisect.bisect_left(self.bounds, v)] += 1
+        self.values[self.sum_index] += v
+
+    def samples(self):
+        counts = self.values[self.index:self.sum_index]
+        samples = []
+        total = 0
+        for (bound, n) in zip(list(self.bounds) + ['+Inf'], counts):
+            total += n
+            samples.append(('_bucket', (('le', str(bound)),), total))
+        samples.append(('_sum', (), self.values[self.sum_index]))
+        samples.append(('_count', (), total))
+        return samples
+
+class Metrics:
+    """
+    I'm a registry of metrics.
+
+    Counters and histograms are kept in one list, values, and a counter
+    is updated by index, like so:
+
+        metrics.values[index] += n
+
+    which costs about as much as updating an attribute, so that they
+    can be updated for every chunk of console data. Updates aren't
+    locked; a counter that several threads update at once may miss one
+    now and then, which is fine for telling what a server is up to.
+
+    Everything else is read when the metrics are collected, by a
+    function given to family.
+    """
+    def __init__(self):
+        self.values = []
+        # (name, type, help, function returning (suffix, labels, value)s)
+        self.families = []
+
+    def family(self, name, kind, help, collect):
+        """
+        Add a metric, which collect() returns the samples of, as a list
+        of (name suffix, labels, value). labels is a tuple of (label,
+        value) pairs.
+        """
+        self.families.append((name, kind, help, collect))
+
+    def counter(self, name, help):
+        """
+        Add a counter, and return its index in values.
+        """
+        index = len(self.values)
+        self.values.append(0)
+        self.family(name, COUNTER, help, lambda: [('', (), self.values[index])])
+        return index
+
+    def gauge(self, name, help, func):
+        """
+        Add a gauge whose value is func().
+        """
+        self.family(name, GAUGE, help, lambda: [('', (), func())])
+
+    def labelled(self, name, kind, help, label, func):
+        """
+        Add a metric with a value for each label value; func returns
+        them as a dict.
+        """
+        self.family(name, kind, help,
+                    lambda: [('', ((label, k),), v) for (k, v) in sorted(func().items())])
+
+    def histogram(self, name, help, bounds):
+        """
+        Add a histogram with buckets for values up to each of bounds,
+        and return it.
+        """
+        index = len(self.values)
+        self.values.extend([0] * (len(bounds) + 2))
+        hist = Histogram(self.values, index, tuple(bounds))
+        self.family(name, HISTOGRAM, help, hist.samples)
+        return hist
+
+    def collect(self):
+        """
+        Return every metric, as a list of (name, type, help, samples).
+        """
+        collected = []
+        for (name, kind, help, collect) in self.families:
+            try:
+                samples = collect()
+            except Exception:
+                logging.exception('collecting metric %s', name)
+                continue
+            collected.append((name, kind, help, samples))
+        return collected
+
+def quote_label(v):
+    return '"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return '%d' % v
+
+def format_text(collected):
+    """
+    Return metrics, as returned by Metrics.collect, in the Prometheus
+    text format.
+    """
+    lines = []
+    for (name, kind, help, samples) in collected:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (suffix, labels, value) in samples:
+            if labels:
+                labels = '{%s}' % ','.join('%s=%s' % (k, quote_label(v)) for (k, v) in labels)
+            else:
+                labels = ''
+            lines.append('%s%s%s %s' % (name, suffix, labels, format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def read_request(sock):
+    """
+    Read the head of an HTTP request from sock, and return its request
+    line split into words. Give up if that takes longer than
+    HTTP_DEADLINE, however the scraper trickles it in.
+    """
+    deadline = time.time() + HTTP_DEADLINE
+    head = ''
+    while '\n\n' not in head and '\n\r\n' not in head:
+        left = deadline - time.time()
+        if left <= 0:
+            raise socket.timeout('request took longer than %gs' % HTTP_DEADLINE)
+        sock.settimeout(min(left, HTTP_TIMEOUT))
+        data = sock.recv(1024)
+        if not data:
+            break
+        head += data
+        if len(head) > HTTP_MAX_REQUEST:
+            raise IOError('request longer than %d bytes' % HTTP_MAX_REQUEST)
+    return head.split('\n', 1)[0].split()
+
+def answer_http(sock, metrics):
+    """
+    Answer an HTTP request on sock, a connection to the metrics port,
+    with metrics in the Prometheus text format, and close sock.
+    """
+    sock.setblocking(1)
+    try:
+        try:
+            request = read_request(sock)
+            if len(request) < 2 or request[0] not in ('GET', 'HEAD'):
+                status, body = '405 Method Not Allowed', ''
+            elif request[1].split('?')[0] not in ('/', '/metrics'):
+                status, body = '404 Not Found', ''
+            else:
+                status, body = '200 OK', format_text(metrics.collect())
+            head = ('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n' %
+                    (status, CONTENT_TYPE, len(body)))
+            if request and request[0] == 'HEAD':
+                body = ''
+            sock.settimeout(HTTP_TIMEOUT)
+            sock.sendall(head + body)
+        except (EOFError, IOError, socket.error), e:
+            logging.debug('metrics request failed: %s', e)
+    finally:
+        sock.close()
+
+def serve_http(listener, metrics):
+    """
+    Answer the HTTP requests made on listener, one at a time, forever.
+    """
+    listener.setblocking(1)
+    while True:
+        try:
+            (sock, addr) = listener.accept()
+        except socket.error, e:
+            if e.errno in (errno.EINTR, errno.ECONNABORTED):
+                continue
+            # Out of file descriptors, most likely; don't spin
+            logging.error('metrics port accept failed: %s', e)
+            time.sleep(1)
+            continue
+        try:
+            answer_http(sock, metrics)
+        except Exception:
+            logging.exception('metrics request failed')
+
+def start_http(listener, metrics):
+    """
+    Serve metrics over HTTP on listener from a thread of its own, so
+    that slow scrapers don't hold up anything else.
+    """
+    th = threading.Thread(target = serve_http, args = (listener, metrics), name = 'metrics')
+    th.daemon = True
+    th.start()
+    return th
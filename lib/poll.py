@@ -29,20 +29,43 @@
 # or implied, of <copyright holder>.
 
 import errno
+import fcntl
 import logging
+import math
+import os
 import select
 import threading
+import time
 
-class PollEventSource:
+from vSPC.metrics import COUNTER, GAUGE
+
+class PollEventSource(object):
     """
     Encapsulates epoll state around a stream provided by other code.
     """
+    # There is one of these for every VM connection, client connection
+    # and VM port listener
+    __slots__ = ('fileno', 'stream', 'read_handler', 'write_handler', 'mask', 'oneshot',
+                 'reading')
+
     def __init__(self, stream):
         self.fileno        = stream.fileno()
         self.stream        = stream
         self.read_handler  = None
         self.write_handler = None
         self.mask          = select.EPOLLERR | select.EPOLLHUP
+        self.oneshot       = False
+        # False while a one-shot stream's reads are suspended, so that
+        # changing its write events doesn't rearm them
+        self.reading       = True
+
+    def enable_oneshot(self):
+        """
+        Alter epoll mask so the stream is edge triggered and disarmed by
+        the kernel after each event, until it is explicitly rearmed.
+        """
+        self.oneshot = True
+        self.mask |= select.EPOLLET | select.EPOLLONESHOT
 
     def enable_writes(self):
         """Alter epoll mask so epoll triggers on write events"""
@@ -60,6 +83,125 @@ class PollEventSource:
         """Alter epoll mask for epoll doesn't trigger on read events"""
         self.mask &= ~select.EPOLLIN
 
+    def armed_mask(self):
+        """Return the epoll mask, less read events if they are suspended"""
+        if self.reading:
+            return self.mask
+        return self.mask & ~select.EPOLLIN
+
+class Timer(object):
+    """
+    A callback scheduled with Poller.call_later. Pass it to
+    Poller.cancel to unschedule it.
+    """
+    __slots__ = ('func', 'due', 'slot')
+
+    def __init__(self, func, due):
+        self.func   = func
+        # The wheel tick we fire at
+        self.due    = due
+        # The wheel slot we're filed in; None once fired or cancelled
+        self.slot   = None
+
+class TimerWheel:
+    """
+    A hashed timer wheel.
+
+    Time is divided into ticks, and a timer due at tick t is filed in
+    slot t % len(slots). Adding, cancelling and expiring a timer are all
+    O(1). The wheel only visits the ticks timers are due at: the
+    earliest due tick is worked out by looking at the slots from the
+    current tick on, and kept until that timer fires or is cancelled.
+
+    TimerWheel isn't thread safe; Poller serializes access to it.
+    """
+    def __init__(self, tick, nslots):
+        self.tick    = tick
+        self.slots   = [set() for i in range(nslots)]
+        self.count   = 0
+        self.epoch   = time.time()
+        # Last tick processed
+        self.current = 0
+        # Earliest tick a timer is due at, or None if that needs working
+        # out again; see next_due
+        self.earliest = None
+
+    def _ticks(self, when):
+        return int((when - self.epoch) / self.tick)
+
+    def add(self, delay, func, now):
+        if not self.count:
+            # Nothing to process; skip any idle ticks
+            self.current = self._ticks(now)
+            self.earliest = None
+
+        due = int(math.ceil((now + delay - self.epoch) / self.tick))
+        due = max(due, self.current + 1)
+        timer = Timer(func, due)
+        timer.slot = self.slots[due % len(self.slots)]
+        timer.slot.add(timer)
+        if not self.count or (self.earliest is not None and due < self.earliest):
+            self.earliest = due
+        self.count += 1
+        return timer
+
+    def remove(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+            if timer.due == self.earliest:
+                self.earliest = None
+
+    def next_due(self):
+        """
+        Return the earliest tick a timer is due at, or None if there is
+        nothing on the wheel.
+        """
+        if not self.count:
+            return None
+        if self.earliest is None:
+            # Timers in the slot offset ticks on are due offset ticks on
+            # at the earliest, so the first slots with timers in them
+            # hold the earliest one
+            nslots = len(self.slots)
+            for offset in range(1, nslots + 1):
+                tick = self.current + offset
+                if self.earliest is not None and tick >= self.earliest:
+                    break
+                for timer in self.slots[tick % nslots]:
+                    if self.earliest is None or timer.due < self.earliest:
+                        self.earliest = timer.due
+        return self.earliest
+
+    def next_wait(self, now):
+        """
+        Return how long to wait before the next timer is due, or None if
+        there is nothing on the wheel.
+        """
+        due = self.next_due()
+        if due is None:
+            return None
+        return max(0, self.epoch + due * self.tick - now)
+
+    def advance(self, now):
+        """
+        Process all ticks up to now. Return the timers that expired.
+        """
+        target = self._ticks(now)
+        expired = []
+        while self.count:
+            due = self.next_due()
+            if due > target:
+                break
+            self.current = due
+            for timer in list(self.slots[due % len(self.slots)]):
+                if timer.due <= due:
+                    self.remove(timer)
+                    expired.append(timer)
+        self.current = max(self.current, target)
+        return expired
+
 class Poller:
     """
     Manage & respond to events on a set of streams.
@@ -72,8 +214,32 @@ class Poller:
 
     Poller uses Linux's epoll facility to work. See epoll(7) for more
     information on epoll.
+
+    If edge_triggered is set, readers added with oneshot=True are
+    registered with EPOLLET | EPOLLONESHOT. The kernel disarms such a
+    stream as soon as it reports an event, so the read handler no longer
+    needs to call del_reader to avoid being alerted repeatedly on the
+    same input; it calls resume_reader once it has drained the stream
+    (read until EAGAIN) instead. Rearming re-evaluates readiness, so any
+    data that arrived in the meantime will be reported again.
+
+    Poller can also run callbacks after a delay; see call_later. Timers
+    are kept on a TimerWheel, and the epoll timeout is shortened to when
+    the next one is due.
     """
-    def __init__(self):
+    # Resolution of call_later, in seconds
+    TIMER_TICK = 0.05
+    # Size of the timer wheel; timers further out than
+    # TIMER_TICK * TIMER_SLOTS seconds go around more than once.
+    TIMER_SLOTS = 512
+
+    # Errors and hangups are passed to the read handler, which will
+    # notice them when reading, or to the write handler if there is no
+    # read handler.
+    ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP
+    READ_EVENTS = select.EPOLLIN | select.EPOLLPRI | ERROR_EVENTS
+
+    def __init__(self, edge_triggered = False, maxevents = -1):
         # stream => PollEventSource instance
         # used to translate arguments from higher level code
         self.event_sources_by_stream = {}
@@ -90,7 +256,34 @@ class Poller:
         # lock.
         self.lock = threading.Lock()
 
+        self.edge_triggered = edge_triggered
+        # Most events to handle per wakeup; -1 means no limit
+        self.maxevents = maxevents
+
+        # Counters for poll_stats
+        self.wakeups = 0
+        self.events_handled = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.handler_time = 0.0
+
+        # Timers may be added from any thread, and fire on the thread
+        # running run_once. A pipe is used to wake that thread up when
+        # the first timer is added, since it may be blocked in epoll
+        # without a timeout.
+        self.timers = TimerWheel(self.TIMER_TICK, self.TIMER_SLOTS)
+        self.timer_lock = threading.Lock()
+        self.setup_epoll()
+
+    def setup_epoll(self):
+        """
+        Create the epoll object, and the pipe that wakes it up for timers.
+        """
         self.epoll = select.epoll()
+        (self.waker_fd, self.waker_wfd) = os.pipe()
+        for fd in (self.waker_fd, self.waker_wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.epoll.register(self.waker_fd, select.EPOLLIN)
 
     def unsafe_has_stream(self, stream):
         """
@@ -108,9 +301,12 @@ class Poller:
         self.event_sources_by_fileno[pes.fileno] = pes
         self.epoll.register(pes.fileno, pes.mask)
 
-    def add_reader(self, stream, func):
+    def add_reader(self, stream, func, oneshot = False):
         """
         Associate func with stream's read events.
+
+        If oneshot is set and the Poller is edge triggered, the stream is
+        disarmed after each event; see suspend_reader and resume_reader.
         """
         with self.lock:
             if not self.unsafe_has_stream(stream):
@@ -119,6 +315,9 @@ class Poller:
             pes = self.event_sources_by_stream[stream]
             pes.read_handler = func
             pes.enable_reads()
+            pes.reading = True
+            if oneshot and self.edge_triggered:
+                pes.enable_oneshot()
 
             self.epoll.modify(pes.fileno, pes.mask)
 
@@ -134,6 +333,38 @@ class Poller:
             except KeyError:
                 pass
 
+    def suspend_reader(self, stream):
+        """
+        Stop watching for read events on stream while its read handler
+        works on it. One-shot streams were already disarmed by the
+        kernel when the event was reported, so this costs nothing for
+        them, other than remembering not to rearm them along with write
+        events.
+        """
+        pes = self.event_sources_by_stream.get(stream)
+        if pes is not None and pes.oneshot:
+            pes.reading = False
+            return
+        self.del_reader(stream)
+
+    def resume_reader(self, stream, func):
+        """
+        Start watching for read events on stream again after
+        suspend_reader. One-shot streams are rearmed with a single
+        epoll_ctl call and without taking the Poller lock.
+        """
+        pes = self.event_sources_by_stream.get(stream)
+        if pes is None or not pes.oneshot:
+            self.add_reader(stream, func)
+            return
+        pes.reading = True
+        try:
+            self.epoll.modify(pes.fileno, pes.mask)
+        except IOError, e:
+            # The stream was closed or deleted under us.
+            if e.errno not in (errno.EBADF, errno.ENOENT):
+                raise
+
     def add_writer(self, stream, func):
         """
         Associate func with stream's write events.
@@ -146,7 +377,7 @@ class Poller:
             pes.write_handler = func
             pes.enable_writes()
 
-            self.epoll.modify(pes.fileno, pes.mask)
+            self.epoll.modify(pes.fileno, pes.armed_mask())
 
     def del_writer(self, stream):
         """
@@ -156,7 +387,7 @@ class Poller:
             try:
                 pes = self.event_sources_by_stream[stream]
                 pes.disable_writes()
-                self.epoll.modify(pes.fileno, pes.mask)
+                self.epoll.modify(pes.fileno, pes.armed_mask())
             except KeyError:
                 pass
 
@@ -192,12 +423,59 @@ class Poller:
         del self.event_sources_by_fileno[pes.fileno]
         self.epoll.unregister(pes.fileno)
 
+    def call_later(self, delay, func):
+        """
+        Call func with no arguments, on the thread running the Poller,
+        once delay seconds have passed. Return a Timer that can be given
+        to cancel.
+        """
+        with self.timer_lock:
+            before = self.timers.next_due()
+            timer = self.timers.add(delay, func, time.time())
+        # The thread running the Poller may be sleeping until a later
+        # timer is due, or for good
+        if before is None or timer.due < before:
+            try:
+                os.write(self.waker_wfd, 'x')
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        return timer
+
+    def cancel(self, timer):
+        """
+        Unschedule a timer returned by call_later. Does nothing if it
+        already fired.
+        """
+        with self.timer_lock:
+            self.timers.remove(timer)
+
+    def run_timers(self):
+        """
+        Call the functions of any timers that are due.
+        """
+        with self.timer_lock:
+            expired = self.timers.advance(time.time())
+        for timer in expired:
+            try:
+                timer.func()
+            except Exception, e:
+                logging.exception("Timer exception caught")
+
     def run_once(self, timeout = -1):
         """
-        Poll for events on monitored streams, then process them.
+        Poll for events on monitored streams, then process them, then
+        run any timers that are due.
         """
+        with self.timer_lock:
+            wait = self.timers.next_wait(time.time())
+        if wait is not None and (timeout < 0 or wait < timeout):
+            # epoll takes whole milliseconds, and rounds down; waking
+            # up before the timer is due would only mean polling again
+            timeout = math.ceil(wait * 1000) / 1000.0
+
         try:
-            events = self.epoll.poll(timeout)
+            events = self.epoll.poll(timeout, self.maxevents)
         except IOError, e:
             if e.errno == errno.EINTR:
                 # interrupted syscall; continue w/o error
@@ -206,27 +484,84 @@ class Poller:
             # unknown error; raise exception
             raise
 
-        for (fileno, event) in events:
-            if event == select.EPOLLIN or event == select.EPOLLERR or event == select.EPOLLHUP:
-                # read event, or error condition that we should treat like a read event
-                with self.lock:
-                    pes = self.event_sources_by_fileno[fileno]
-                    handler = pes.read_handler
-                handler(pes.stream)
-            elif event == select.EPOLLOUT:
-                # write event
-                with self.lock:
-                    pes = self.event_sources_by_fileno[fileno]
-                    handler = pes.write_handler
-                handler(pes.stream)
-            else:
+        start = time.time()
+
+        # Look up the event sources for the whole batch under a single
+        # acquisition of the lock. A stream deleted since epoll reported
+        # it has no event source, and its event is dropped.
+        with self.lock:
+            get = self.event_sources_by_fileno.get
+            batch = [(get(fileno), fileno, event) for (fileno, event) in events]
+
+        for (pes, fileno, event) in batch:
+            if pes is None:
+                if fileno == self.waker_fd:
+                    try:
+                        os.read(self.waker_fd, 4096)
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                continue
+
+            handled = False
+            if event & self.READ_EVENTS and pes.read_handler is not None:
+                # read event, or error condition that we should treat
+                # like a read event
+                pes.read_handler(pes.stream)
+                handled = True
+            if pes.write_handler is not None and \
+               (event & select.EPOLLOUT or (event & self.ERROR_EVENTS and not handled)):
+                if handled and self.event_sources_by_fileno.get(fileno) is not pes:
+                    # The read handler deleted the stream
+                    continue
+                pes.write_handler(pes.stream)
+                handled = True
+
+            if not handled:
                 # Event that we don't know how to handle.
                 logging.debug("I was asked to handle an unsupported event (%d) "
-                              "for fd %d. I'm removing fd %d" % (event, fileno, fileno))
+                              "for fd %d. I'm removing fd %d", event, fileno, fileno)
                 with self.lock:
-                    pes = self.event_sources_by_fileno[fileno]
-                    fd = pes.stream
-                    self.unsafe_remove_fd(fd)
+                    if self.event_sources_by_fileno.get(fileno) is pes:
+                        self.unsafe_remove_fd(pes.stream)
+
+        self.wakeups += 1
+        self.events_handled += len(events)
+        self.last_batch = len(events)
+        self.max_batch = max(self.max_batch, len(events))
+        self.handler_time += time.time() - start
+
+        self.run_timers()
+
+    def poll_stats(self):
+        """
+        Return counters describing the work done by run_once so far:
+        the number of wakeups, events handled, the size of the last and
+        largest event batches, and the total time spent in handlers.
+        """
+        return {
+            'wakeups': self.wakeups,
+            'events': self.events_handled,
+            'last_batch': self.last_batch,
+            'max_batch': self.max_batch,
+            'handler_time': self.handler_time,
+        }
+
+    def register_poll_metrics(self, metrics):
+        """
+        Add the counters of poll_stats to metrics, a vSPC.metrics.Metrics.
+        """
+        metrics.family('vspc_poll_wakeups_total', COUNTER, 'Returns from epoll',
+                       lambda: [('', (), self.wakeups)])
+        metrics.family('vspc_poll_events_total', COUNTER, 'Events handled',
+                       lambda: [('', (), self.events_handled)])
+        metrics.family('vspc_poll_max_batch', GAUGE, 'Most events handled in one wakeup',
+                       lambda: [('', (), self.max_batch)])
+        metrics.family('vspc_poll_handler_seconds_total', COUNTER,
+                       'Time spent in event handlers on the polling thread',
+                       lambda: [('', (), self.handler_time)])
+        metrics.gauge('vspc_poll_streams', 'Streams being polled',
+                      lambda: len(self.event_sources_by_fileno))
 
     def run_forever(self):
         """
@@ -0,0 +1,109 @@
+# vSPC/ports.py -- allocation of the ports that VM listeners bind to
+
+import collections
+
+class PortAllocator:
+    """
+    I hand out the ports in range(start, end + 1, step) to VMs.
+
+    Ports that were never handed out are taken in order, starting at
+    start; ports given back are kept on a free list, oldest first. Both
+    allocate and free are O(1).
+
+    I remember which uuid last held each port. A uuid that comes back
+    gets its old port again if nobody else took it in the meantime,
+    and ports go back on the end of the free list, so a port is only
+    handed to another uuid once the ports freed before it are used up.
+
+    Ports outside my range (e.g. persisted from an older configuration,
+    or held by another vSPC worker) can be reserved, so that I never
+    hand them out.
+
+    PortAllocator isn't thread safe; vSPC serializes access to it.
+    """
+    def __init__(self, start, end, step = 1):
+        assert start <= end and step >= 1
+        self.start = start
+        self.end = end
+        self.step = step
+        # Lowest port in range that was never handed out
+        self.next = start
+        # Ports in range that were handed out and given back, as an
+        # ordered set
+        self.free = collections.OrderedDict()
+        # port => uuid, for every port in use or reserved
+        self.owners = {}
+        # uuid => port it last held, and the other way around
+        self.affinity = {}
+        self.last_holder = {}
+
+    def in_range(self, port):
+        return self.start <= port <= self.end and (port - self.start) % self.step == 0
+
+    def allocate(self, uuid):
+        """
+        Return a free port for uuid, or None if the range is used up.
+        """
+        port = self.affinity.get(uuid)
+        if port is not None and port in self.free:
+            del self.free[port]
+        elif self.free:
+            (port, _) = self.free.popitem(last = False)
+        else:
+            port = self._allocate_new()
+            if port is None:
+                return None
+        self._take(port, uuid)
+        return port
+
+    def _allocate_new(self):
+        while self.next <= self.end:
+            port = self.next
+            self.next += self.step
+            # Reserved ports are skipped once, as next passes them
+            if port not in self.owners:
+                return port
+        return None
+
+    def _take(self, port, uuid):
+        self.owners[port] = uuid
+        old = self.last_holder.get(port)
+        if old is not None and old != uuid and self.affinity.get(old) == port:
+            del self.affinity[old]
+        # uuid forgets its previous port, which forgets uuid in turn
+        prev = self.affinity.get(uuid)
+        if prev is not None and prev != port and self.last_holder.get(prev) == uuid:
+            del self.last_holder[prev]
+        self.last_holder[port] = uuid
+        self.affinity[uuid] = port
+
+    def reserve(self, port, uuid):
+        """
+        Mark port as held by uuid, whether or not it is in range.
+        """
+        assert port not in self.owners
+        if port in self.free:
+            del self.free[port]
+        if self.in_range(port):
+            self._take(port, uuid)
+        else:
+            self.owners[port] = uuid
+
+    def free_port(self, port):
+        """
+        Give back a port that was allocated or reserved.
+        """
+        del self.owners[port]
+        if self.in_range(port) and port < self.next:
+            self.free[port] = True
+
+    def skip(self, port):
+        """
+        Give back a port that turned out to be in use by someone else,
+        so that it's tried again only once the other free ports are used
+        up.
+        """
+        self.free_port(port)
+        uuid = self.last_holder.pop(port, None)
+        if uuid is not None and self.affinity.get(uuid) == port:
+            del self.affinity[uuid]
@@ -33,32 +33,137 @@ __author__ = "Zachary M. Loafman"
 __copyright__ = "Copyright (C) 2011 Isilon Systems LLC."
 __revision__ = "$Id$"
 
+import collections
+import errno
+import heapq
 import logging
 import socket
 import ssl
 import time
 import threading
-import Queue
 
-from telnetlib import BINARY, SGA, ECHO
+from telnetlib import BINARY, SGA, ECHO, IAC, SB, SE, WILL, NEW_ENVIRON
 
+from vSPC.metrics import Metrics, COUNTER, GAUGE, start_http
 from vSPC.poll import Poller, Selector
-from vSPC.telnet import TelnetServer, VMTelnetServer, VMExtHandler, hexdump
-
-LISTEN_BACKLOG = 5
-
-def openport(port, iface="", use_ssl=False, ssl_cert=None, ssl_key=None):
+from vSPC.ports import PortAllocator
+from vSPC.taskpool import TaskPool
+from vSPC.trace import lazy, debug_enabled, event_ring, record, format_events
+from vSPC.telnet import TelnetServer, VMTelnetServer, VMExtHandler, SendAccounting, hexdump, UNACK_TIMEOUT, \
+    SEND_HIGH_WATER, SEND_LOW_WATER, RECV_SIZE, ENV_IS, ENV_INFO, ENV_SEND, ENV_VAR, ENV_USERVAR, parse_environ, \
+    escape_iac
+
+# Default backlog of the listening sockets. When an ESX host comes back
+# it reconnects all of its VMs at once, so this needs to be large; the
+# kernel caps it at net.core.somaxconn.
+LISTEN_BACKLOG = 1024
+
+# Most connections accepted from one listener per poll wakeup, so that
+# a storm on one port doesn't starve the others
+ACCEPT_BATCH = 64
+
+# Default end of the VM port range
+VM_PORT_END = 65535
+
+# How many ports to try when ports turn out to be in use by others
+PORT_BIND_RETRIES = 16
+
+# How often idle task threads are retired, in seconds
+TASK_TRIM_INTERVAL = 10
+
+# What to do about a client whose send queue reaches its high water
+# mark because it can't keep up with its VM's output:
+# forget the client's oldest queued output
+SLOW_CLIENT_DROP = 'drop'
+# disconnect the client
+SLOW_CLIENT_DISCONNECT = 'disconnect'
+# stop reading from the VM while all its clients are that far behind;
+# while only some are, their oldest output is dropped
+SLOW_CLIENT_PAUSE = 'pause'
+SLOW_CLIENT_POLICIES = (SLOW_CLIENT_DROP, SLOW_CLIENT_DISCONNECT, SLOW_CLIENT_PAUSE)
+
+# Output of a VM whose clients typed something within this many seconds
+# isn't coalesced, so that echoes aren't held back
+INTERACTIVE_TIME = 1.0
+
+# Most VM output to hold back while the VM is being vMotioned; past
+# this, the oldest is dropped
+VMOTION_HOLD_BYTES = 64 * 1024
+
+# Most orphaned VMs to expire in one task; if more are due, the rest
+# are left to another task
+ORPHAN_BATCH = 100
+
+# Most seconds a TLS handshake on the proxy port may take
+TLS_HANDSHAKE_TIMEOUT = 10
+
+# How many restored VMs start listening for their clients in one task;
+# see vSPC.bind_restored_vms
+RESTORE_BIND_BATCH = 200
+
+# Clients of the client port say which VM they want, by name or uuid,
+# in this NEW-ENVIRON user variable (or in USER, so that "telnet -l vm"
+# works), or else on a line of their own, after ROUTE_PROMPT
+ROUTE_VAR = 'VM'
+ROUTE_PROMPT = 'VM name or uuid: '
+ROUTE_NOT_FOUND = 'No VM named %s\r\n'
+# Longest line a client can give as a VM name, and how many names it
+# can try before it is disconnected
+ROUTE_LINE_MAX = 256
+ROUTE_ATTEMPTS = 3
+
+# Not exported by all Python 2 builds; this is the Linux value.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+def openport(port, iface="", reuse_port=False, backlog=LISTEN_BACKLOG):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    if use_ssl:
-        sock = ssl.wrap_socket(sock, keyfile=ssl_key, certfile=ssl_cert)
     sock.setblocking(0)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1);
+    if reuse_port:
+        # Let every vSPC worker process accept on the same port
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
     sock.bind((iface, port))
-    sock.listen(LISTEN_BACKLOG)
+    sock.listen(backlog)
     return sock
 
+def accept_all(listener):
+    """
+    Return the sockets of the connections waiting on listener, up to
+    ACCEPT_BATCH of them. The listener must be non-blocking.
+    """
+    socks = []
+    while len(socks) < ACCEPT_BATCH:
+        try:
+            socks.append(listener.accept()[0])
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            if e.args[0] in (errno.ECONNABORTED, errno.EPROTO):
+                # Gone before we got to it
+                continue
+            # e.g. out of file descriptors; leave the rest for later
+            logging.warn('accept failed: %s' % e)
+            break
+    return socks
+
+def make_ssl_context(ssl_cert, ssl_key=None):
+    """
+    Return the SSLContext for connections to the proxy port. Every
+    connection shares it, and with it the session cache and ticket key,
+    so that ESXi hosts that reconnect can resume their sessions.
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    ctx.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    ctx.load_cert_chain(ssl_cert, ssl_key)
+    return ctx
+
 class vSPC(Poller, VMExtHandler):
-    class Vm:
+    class Vm(object):
+        __slots__ = ('vts', 'clients', 'uuid', 'name', 'port', 'listener', 'last_time',
+                     'vmotion', 'paused', 'output_lock', 'held', 'held_bytes', 'pending',
+                     'pending_bytes', 'pending_since', 'flush_timer', 'last_input', 'parked',
+                     'output_bytes', 'input_bytes')
+
         def __init__(self, uuid = None, name = None, vts = None):
             self.vts = vts if vts else []
             self.clients = []
@@ -68,21 +173,110 @@ class vSPC(Poller, VMExtHandler):
             self.listener = None
             self.last_time = None
             self.vmotion = None
+            # Set while reads from the VM are held off for its clients
+            self.paused = False
+            # Output held back for coalescing or during a vMotion; see
+            # vSPC.vm_output. output_lock keeps the VM's output in order.
+            # held, pending and parked are empty tuples until there is
+            # something to put in them, as for most VMs there never is.
+            self.output_lock = threading.RLock()
+            self.held = ()
+            self.held_bytes = 0
+            self.pending = ()
+            self.pending_bytes = 0
+            self.pending_since = None
+            self.flush_timer = None
+            # When a client last sent the VM anything
+            self.last_input = 0
+            # Clients not read from until the VM's vMotion is over
+            self.parked = ()
+            # Bytes the VM sent, and bytes its clients sent it
+            self.output_bytes = 0
+            self.input_bytes = 0
 
         def fileno(self):
             return self.listener.fileno()
 
+    class Handshake(object):
+        """
+        A TLS handshake on a new VM connection; see vSPC.continue_tls.
+        """
+        __slots__ = ('sock', 'peer', 'start', 'timer', 'watched')
+
+        def __init__(self, sock):
+            self.sock = sock
+            # Looked up now, as the peer may be gone by the time we log it
+            try:
+                self.peer = sock.getpeername()[0]
+            except socket.error:
+                self.peer = None
+            self.start = time.time()
+            self.timer = None
+            # Set once the Poller watches sock for us
+            self.watched = False
+
+        def fileno(self):
+            return self.sock.fileno()
+
     class Client(TelnetServer):
+        __slots__ = ('uuid', 'peer')
+
         def __init__(self, sock,
                      server_opts = (BINARY, SGA, ECHO),
-                     client_opts = (BINARY, SGA)):
-            TelnetServer.__init__(self, sock, server_opts, client_opts)
+                     client_opts = (BINARY, SGA),
+                     negotiate = True):
+            TelnetServer.__init__(self, sock, server_opts, client_opts, negotiate)
             self.uuid = None
+            try:
+                self.peer = '%s:%d' % sock.getpeername()[:2]
+            except socket.error:
+                self.peer = None
+
+    class RoutedClient(Client):
+        """
+        A client of the client port, which doesn't know which VM it is
+        for until the client tells it; see vSPC.process_route_data.
+        """
+        __slots__ = ('environ', 'environ_asked', 'route_line', 'route_attempts', 'prompted')
+
+        def __init__(self, sock):
+            vSPC.Client.__init__(self, sock,
+                                 client_opts = (BINARY, SGA, NEW_ENVIRON))
+            # What the client told us with NEW-ENVIRON
+            self.environ = {}
+            self.environ_asked = False
+            # What the client typed so far, if it was prompted
+            self.route_line = ''
+            self.route_attempts = 0
+            self.prompted = False
+
+        def _option_callback(self, sock, cmd, opt):
+            if cmd == SE and self.sbdataq[:1] == NEW_ENVIRON:
+                data = self.read_sb_data()
+                if data[1:2] in (ENV_IS, ENV_INFO):
+                    self.environ.update(parse_environ(data[2:]))
+                if (NEW_ENVIRON, ENV_IS) in self.unacked:
+                    self.last_ack = time.time()
+                    self.unacked.remove((NEW_ENVIRON, ENV_IS))
+                return
+
+            TelnetServer._option_callback(self, sock, cmd, opt)
+            if cmd == WILL and opt == NEW_ENVIRON and not self.environ_asked:
+                self.environ_asked = True
+                self.sock.sendall(IAC + SB + NEW_ENVIRON + ENV_SEND +
+                                  ENV_USERVAR + ROUTE_VAR + ENV_VAR + 'USER' + IAC + SE)
+                self.unacked.append((NEW_ENVIRON, ENV_IS))
 
     def __init__(self, proxy_port, admin_port, proxy_iface, admin_iface,
                  vm_port_start, vm_iface, vm_expire_time, backend, use_ssl=False,
-                 ssl_cert=None, ssl_key=None):
-        Poller.__init__(self)
+                 ssl_cert=None, ssl_key=None, edge_triggered=False, shards=None,
+                 poll_maxevents=-1, inline_data=False, task_threads=4,
+                 send_high_water=SEND_HIGH_WATER, send_low_water=SEND_LOW_WATER,
+                 slow_client_policy=SLOW_CLIENT_DROP, coalesce_delay=0,
+                 coalesce_bytes=16384, vm_port_end=VM_PORT_END, client_port=None,
+                 listen_backlog=LISTEN_BACKLOG, recv_size=RECV_SIZE, trace_events=0,
+                 metrics_port=None, metrics_iface='127.0.0.1'):
+        Poller.__init__(self, edge_triggered, poll_maxevents)
 
         self.proxy_port = proxy_port
         self.admin_port = admin_port
@@ -91,40 +285,119 @@ class vSPC(Poller, VMExtHandler):
         self.admin_iface = admin_iface;
         if not vm_port_start: # account for falsey things, not just None
             vm_port_start = None
-        self.vm_port_next = vm_port_start
+        # When running as one of several worker processes (see
+        # vSPC.shard), each worker owns the VMs whose uuids map to its
+        # shard and allocates VM ports from its own slice of the range.
+        self.shards = shards
+        vm_port_step = 1
+        if shards is not None:
+            vm_port_step = shards.count
+            if vm_port_start is not None:
+                vm_port_start += shards.index
+        self.port_allocator = None
+        if vm_port_start is not None:
+            self.port_allocator = PortAllocator(vm_port_start, vm_port_end, vm_port_step)
+        # One port on vm_iface for clients of every VM, which say which
+        # VM they want once connected; see process_route_data
+        self.client_port = client_port
+        self.listen_backlog = listen_backlog
         self.vm_expire_time = vm_expire_time
         self.backend = backend
 
+        # Tasks for different VMs run in parallel, so the tables below,
+        # and the vts and clients lists of each Vm, are protected by
+        # vms_lock.
+        self.vms_lock = threading.RLock()
+        # Heap of [expiry time, uuid, valid] entries for VMs without
+        # connections, and uuid => the valid entry for each of them.
+        # Entries are invalidated rather than taken off the heap.
         self.orphans = []
+        self.orphan_entries = {}
+        self.orphan_timer = None
+        self.orphans_expired = 0
         self.vms = {}
-        self.ports = {}
+        # (Vm, persisted port) for restored VMs not listening yet
+        self.unbound_vms = collections.deque()
+        # When run() was called, and when the first VM connection was
+        # accepted after that
+        self.start_time = None
+        self.first_vm_connection = None
+        # name => uuid and uuid => name, for the VMs of this worker and
+        # of the other workers; see find_vm
+        self.vm_names = {}
+        self.vm_uuids = {}
         self.vmotions = {}
+        # vmotion cookie => uuid, for vmotions begun in other workers
+        self.remote_vmotions = {}
         self.do_ssl = use_ssl
         self.ssl_cert = ssl_cert
         self.ssl_key = ssl_key
-
-        self.task_queue = Queue.Queue()
-        self.task_queue_threads = []
-
-    def _queue_run(self, queue):
-        while True:
-            try:
-                queue.get()()
-            except Exception, e:
-                logging.exception("Worker exception caught")
-
-    def task_queue_run(self):
-        self._queue_run(self.task_queue)
+        self.ssl_context = None
+        if use_ssl:
+            self.ssl_context = make_ssl_context(ssl_cert, ssl_key)
+        # Counts and times of TLS handshakes; see tls_stats
+        self.tls_handshakes = {
+            'ok': 0,
+            'failed': 0,
+            'timed_out': 0,
+            'time': 0.0,
+            'max_time': 0.0,
+        }
+        # Handle console data on the reactor thread once negotiation is
+        # over, instead of handing each read to the task queue
+        self.inline_data = inline_data
+        # VM output is encoded once and queued on every client by
+        # reference; this counts what is waiting to be sent
+        self.send_accounting = SendAccounting()
+        # Send queue water marks for every VM and client connection
+        self.send_high_water = send_high_water
+        self.send_low_water = send_low_water
+        # Most bytes read from a VM or client connection at a time
+        self.recv_size = recv_size
+        # Recent events each VM and client connection keeps, for
+        # dump_events
+        self.trace_events = trace_events
+        assert slow_client_policy in SLOW_CLIENT_POLICIES
+        self.slow_client_policy = slow_client_policy
+        # Hold VM output back for up to coalesce_delay seconds, or until
+        # coalesce_bytes are held, and pass it on in one piece
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_bytes = coalesce_bytes
+
+        # Tasks are kept in order by VM uuid; see queue_stream_task
+        self.task_pool = TaskPool(1, task_threads)
+
+        # See register_metrics. With metrics_port, they are served over
+        # HTTP too.
+        self.metrics = Metrics()
+        self.register_metrics(self.metrics)
+        self.backend.register_metrics(self.metrics)
+        self.metrics_port = metrics_port
+        self.metrics_iface = metrics_iface
 
     def start(self):
-        self.task_queue_threads.append(self._start_thread(self.task_queue_run))
-
-    def _start_thread(self, f):
-        th = threading.Thread(target = f)
-        th.daemon = True
-        th.start()
-
-        return th
+        self.task_pool.start()
+        self.call_later(TASK_TRIM_INTERVAL, self.trim_task_pool)
+
+    def trim_task_pool(self):
+        self.task_pool.trim()
+        self.call_later(TASK_TRIM_INTERVAL, self.trim_task_pool)
+
+    def queue_stream_task(self, ts, func):
+        """
+        Run func(ts) on the task pool, in order with the other tasks of
+        ts's VM. A VM connection's uuid isn't known until it has been
+        negotiated, so until then its tasks are kept in order by the
+        connection itself.
+        """
+        key = ts.task_key or ts
+        def task():
+            if (ts.task_key or ts) != key:
+                # ts's tasks moved into its VM's line while this waited
+                self.queue_stream_task(ts, func)
+            else:
+                func(ts)
+        self.task_pool.put(key, task)
 
     def send_buffered(self, ts, s = ''):
         if ts.send_buffered(s):
@@ -132,346 +405,1344 @@ class vSPC(Poller, VMExtHandler):
         else:
             self.del_writer(ts)
 
+        if not ts.send_blocked and isinstance(ts, self.Client):
+            vm = self.vms.get(ts.uuid)
+            if vm is not None and vm.paused:
+                self.resume_vm(vm)
+
+    def setup_stream(self, ts):
+        ts.set_water_marks(self.send_high_water, self.send_low_water)
+        ts.recv_size = self.recv_size
+        ts.events = event_ring(self.trace_events)
+
+    def send_shared(self, vm, s):
+        """
+        Send s to each of vm's clients. s is encoded once, and the
+        result is shared by the clients' send queues.
+        """
+        chunk = self.send_accounting.share(s)
+        clients = vm.clients[:]
+        slow = []
+        for cl in clients:
+            try:
+                self.send_buffered(cl, chunk)
+            except (EOFError, IOError, socket.error), e:
+                cl.trace('send error: %s', e)
+                self.abort_client_connection(cl)
+                continue
+            if cl.send_blocked:
+                slow.append(cl)
+        if slow:
+            self.handle_slow_clients(vm, slow)
+
+    def handle_slow_clients(self, vm, slow):
+        """
+        Apply slow_client_policy to those of vm's clients, slow, whose
+        send queues are at their high water mark.
+        """
+        policy = self.slow_client_policy
+        if policy == SLOW_CLIENT_PAUSE:
+            with self.vms_lock:
+                if len(slow) == len(vm.clients):
+                    vm.paused = True
+                else:
+                    policy = SLOW_CLIENT_DROP
+
+        for cl in slow:
+            if policy == SLOW_CLIENT_DISCONNECT:
+                logging.info('uuid %s client %s is too slow, disconnecting',
+                             vm.uuid, cl.peer)
+                self.abort_client_connection(cl)
+            elif policy == SLOW_CLIENT_DROP:
+                dropped = cl.drop_oldest()
+                logging.info('uuid %s client %s is too slow, dropped %d bytes',
+                             vm.uuid, cl.peer, dropped)
+            else:
+                logging.info('uuid %s client %s is too slow, pausing VM',
+                             vm.uuid, cl.peer)
+            self.slow_client_actions[policy] += 1
+            self.backend.notify_slow_client(vm.uuid, cl.peer, policy)
+
+    def resume_vm(self, vm):
+        """
+        Go back to reading from vm once one of its clients catches up,
+        or goes away.
+        """
+        with self.vms_lock:
+            if not vm.paused:
+                return
+            logging.debug('uuid %s resuming VM', vm.uuid)
+            vm.paused = False
+            for vt in vm.vts:
+                self.add_reader(vt, self.queue_new_vm_data, oneshot = True)
+
     def new_vm_connection(self, sock):
         sock.setblocking(0)
         sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        vt = VMTelnetServer(sock, handler = self)
-        self.add_reader(vt, self.queue_new_vm_data)
+        try:
+            vt = VMTelnetServer(sock, handler = self)
+        except (EOFError, IOError, socket.error), e:
+            logging.debug('VM socket closed during negotiation: %s', e)
+            self.metrics.values[self.count_unidentified_vms] += 1
+            sock.close()
+            return
+        self.setup_stream(vt)
+        self.add_reader(vt, self.queue_new_vm_data, oneshot = True)
+        self.watch_negotiation(vt, self.new_vm_data)
 
     def queue_new_vm_connection(self, listener):
+        socks = accept_all(listener)
+        self.metrics.values[self.count_vm_connections] += len(socks)
+
+        if socks and self.first_vm_connection is None:
+            self.first_vm_connection = time.time()
+            logging.info('First VM connection accepted %.3fs after startup'
+                         % (self.first_vm_connection - self.start_time))
+        for sock in socks:
+            if self.ssl_context is not None:
+                self.start_tls(sock)
+            else:
+                self.task_pool.put(None, lambda sock = sock: self.new_vm_connection(sock))
+
+    def start_tls(self, sock):
+        """
+        Begin the TLS handshake on a new VM connection. The handshake is
+        carried on by the reactor as the peer responds, so that a slow
+        peer doesn't hold up anyone else.
+        """
+        sock.setblocking(0)
+        hs = self.Handshake(self.ssl_context.wrap_socket(sock, server_side = True,
+                                                         do_handshake_on_connect = False))
+        hs.timer = self.call_later(TLS_HANDSHAKE_TIMEOUT, lambda: self.abort_tls(hs, None))
+        self.continue_tls(hs)
+
+    def continue_tls(self, hs):
         try:
-            sock = listener.accept()[0]
-        except ssl.SSLError:
+            hs.sock.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.del_writer(hs)
+                self.add_reader(hs, self.continue_tls)
+                hs.watched = True
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.del_reader(hs)
+                self.add_writer(hs, self.continue_tls)
+                hs.watched = True
+            else:
+                self.abort_tls(hs, e)
+            return
+        except socket.error, e:
+            self.abort_tls(hs, e)
             return
 
-        self.task_queue.put(lambda: self.new_vm_connection(sock))
+        self.cancel(hs.timer)
+        if hs.watched:
+            self.delete_stream(hs)
+        elapsed = time.time() - hs.start
+        self.tls_handshakes['ok'] += 1
+        self.tls_handshakes['time'] += elapsed
+        self.tls_handshakes['max_time'] = max(self.tls_handshakes['max_time'], elapsed)
+        if debug_enabled():
+            logging.debug('TLS handshake with %s done in %.3fs, %s',
+                          hs.peer, elapsed, hs.sock.cipher()[0])
+
+        sock = hs.sock
+        self.task_pool.put(None, lambda: self.new_vm_connection(sock))
+
+    def abort_tls(self, hs, e):
+        """
+        Give up on hs because of e, or because it took too long if e is
+        None.
+        """
+        if e is None:
+            logging.info('TLS handshake timed out after %ds', TLS_HANDSHAKE_TIMEOUT)
+            self.tls_handshakes['timed_out'] += 1
+        else:
+            logging.info('TLS handshake failed: %s', e)
+            self.tls_handshakes['failed'] += 1
+            self.cancel(hs.timer)
+        if hs.watched:
+            self.delete_stream(hs)
+        hs.sock.close()
+
+    def tls_stats(self):
+        """
+        Return the number of TLS handshakes on the proxy port that were
+        done, failed and timed out, the mean and longest time those done
+        took, in seconds, and how many resumed an earlier session.
+        """
+        stats = dict(self.tls_handshakes)
+        stats['mean_time'] = stats['time'] / stats['ok'] if stats['ok'] else 0.0
+        stats['resumed'] = 0
+        if self.ssl_context is not None:
+            stats['resumed'] = self.ssl_context.session_stats()['hits']
+        return stats
+
+    def register_metrics(self, metrics):
+        """
+        Add the counters this server keeps, and the state worth keeping
+        an eye on, to metrics, a vSPC.metrics.Metrics.
+        """
+        self.register_poll_metrics(metrics)
+
+        self.count_vm_connections = metrics.counter(
+            'vspc_vm_connections_total', 'VM connections accepted on the proxy port')
+        self.count_unidentified_vms = metrics.counter(
+            'vspc_vm_negotiation_failures_total',
+            'VM connections closed before the VM said which VM it is')
+        self.count_attaches = metrics.counter(
+            'vspc_client_attaches_total', 'Clients attached to a VM')
+        self.count_detaches = metrics.counter(
+            'vspc_client_detaches_total', 'Clients that went away from a VM')
+        self.vm_read_sizes = metrics.histogram(
+            'vspc_vm_read_bytes', 'Sizes of the reads of VM output',
+            (16, 64, 256, 1024, 4096, 16384, 65536))
+        metrics.family('vspc_telnet_negotiation_timeouts_total', COUNTER,
+                       'Option negotiations given up on, by VM and client connections',
+                       lambda: [('', (), TelnetServer.negotiation_timeouts)])
+        # policy => times applied to a client
+        self.slow_client_actions = dict((p, 0) for p in SLOW_CLIENT_POLICIES)
+        metrics.labelled('vspc_slow_client_actions_total', COUNTER,
+                         'Clients found too slow, by what was done about it',
+                         'action', lambda: self.slow_client_actions)
+
+        metrics.gauge('vspc_vms', 'VMs known to this process', lambda: len(self.vms))
+        metrics.gauge('vspc_vm_connections', 'Connections from VMs',
+                      lambda: sum(len(vm.vts) for vm in self.vms.values()))
+        metrics.gauge('vspc_clients', 'Clients attached to a VM',
+                      lambda: sum(len(vm.clients) for vm in self.vms.values()))
+        metrics.gauge('vspc_orphan_vms', 'VMs without connections',
+                      lambda: len(self.orphan_entries))
+        metrics.family('vspc_expired_vms_total', COUNTER, 'VMs expired without connections',
+                       lambda: [('', (), self.orphans_expired)])
+        metrics.gauge('vspc_task_queue_depth', 'Tasks waiting for a task thread',
+                      self.task_pool.depth)
+        metrics.gauge('vspc_task_threads', 'Task threads running',
+                      lambda: self.task_pool.threads)
+        metrics.gauge('vspc_shared_send_bytes',
+                      'Bytes of VM output waiting to be sent to clients, counted once '
+                      'however many clients it waits for', lambda: self.send_accounting.bytes)
+        metrics.labelled('vspc_send_queued_bytes', GAUGE,
+                         'Bytes waiting in the send queues of VM and client connections',
+                         'to', self._send_queued)
+        metrics.labelled('vspc_tls_handshakes_total', COUNTER,
+                         'TLS handshakes on the proxy port, by outcome', 'result',
+                         lambda: dict((k, self.tls_handshakes[k])
+                                      for k in ('ok', 'failed', 'timed_out')))
+
+        def per_vm(attr):
+            return lambda: [('', (('uuid', vm.uuid), ('name', vm.name)), getattr(vm, attr))
+                            for vm in self.vms.values()]
+        metrics.family('vspc_vm_output_bytes_total', COUNTER, 'Bytes each VM sent',
+                       per_vm('output_bytes'))
+        metrics.family('vspc_vm_input_bytes_total', COUNTER,
+                       'Bytes the clients of each VM sent it', per_vm('input_bytes'))
+        metrics.family('vspc_vm_clients', GAUGE, 'Clients attached to each VM',
+                       lambda: [('', (('uuid', vm.uuid), ('name', vm.name)), len(vm.clients))
+                                for vm in self.vms.values()])
+
+    def _send_queued(self):
+        queued = {'vm': 0, 'client': 0}
+        for vm in self.vms.values():
+            for vt in list(vm.vts):
+                queued['vm'] += vt.send_queued
+            for cl in list(vm.clients):
+                queued['client'] += cl.send_queued
+        return queued
 
     def new_client_connection(self, sock, vm):
         sock.setblocking(0)
         sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
 
         client = self.Client(sock)
+        self.setup_stream(client)
+        self.attach_client(client, vm)
+
+    def attach_client(self, client, vm):
         client.uuid = vm.uuid
+        client.task_key = vm.uuid
 
-        self.add_reader(client, self.queue_new_client_data)
-        vm.clients.append(client)
+        self.add_reader(client, self.queue_new_client_data, oneshot = True)
+        self.watch_negotiation(client, self.new_client_data)
+        self.metrics.values[self.count_attaches] += 1
+        with self.vms_lock:
+            vm.clients.append(client)
+            self.unstamp_orphan(vm)
+        if vm.paused:
+            self.resume_vm(vm)
 
-        logging.debug('uuid %s new client, %d active clients'
-                      % (client.uuid, len(vm.clients)))
+        client.trace('uuid %s new client, %d active clients', client.uuid, len(vm.clients))
 
     def queue_new_client_connection(self, vm):
-        sock = vm.listener.accept()[0]
-        self.task_queue.put(lambda: self.new_client_connection(sock, vm))
+        for sock in accept_all(vm.listener):
+            self.task_pool.put(vm.uuid, lambda sock = sock: self.new_client_connection(sock, vm))
+
+    def new_routed_client_connection(self, sock):
+        sock.setblocking(0)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+
+        client = self.RoutedClient(sock)
+        self.setup_stream(client)
+        self.add_reader(client, self.queue_new_route_data, oneshot = True)
+        self.watch_negotiation(client, self.new_route_data)
+
+    def queue_new_routed_client_connection(self, listener):
+        for sock in accept_all(listener):
+            self.task_pool.put(None, lambda sock = sock: self.new_routed_client_connection(sock))
+
+    def abort_routed_client(self, client):
+        client.trace('client %s closed before choosing a VM', client.peer)
+        self.delete_stream(client)
+        client.close()
+
+    def new_route_data(self, client):
+        if not client.sock or client.uuid is not None:
+            # Closed or attached to its VM by a task queued before this
+            # one (e.g. the negotiation timeout's, which reads from
+            # client again when done); see new_vm_data
+            return
+        if self.process_route_data(client):
+            self.resume_reader(client, self.queue_new_route_data)
+
+    def queue_new_route_data(self, client):
+        # Don't alert repeatedly on the same input
+        self.suspend_reader(client)
+        self.queue_stream_task(client, self.new_route_data)
+
+    def process_route_data(self, client):
+        """
+        Find out which VM client wants, and attach it to that VM once
+        we know. Return True if client should be read from again for
+        this, False if it was attached or closed.
+        """
+        neg_done = False
+        try:
+            neg_done = client.negotiation_done()
+        except (EOFError, IOError, socket.error):
+            self.abort_routed_client(client)
+            return False
+
+        if not neg_done:
+            self.watch_negotiation(client, self.new_route_data)
+            return True
+
+        try:
+            if not client.prompted:
+                name = client.environ.get(ROUTE_VAR) or client.environ.get('USER')
+                if name and self.route_client(client, name):
+                    return False
+                # Not said, or not one of ours (USER is often just the
+                # client's login); ask
+                client.prompted = True
+                self.send_buffered(client, ROUTE_PROMPT)
+
+            s = client.read_very_lazy()
+            while s:
+                ends = [i for i in (s.find('\r'), s.find('\n')) if i >= 0]
+                if not ends:
+                    return self.route_typed(client, s)
+                end = min(ends)
+                if not self.route_typed(client, s[:end]):
+                    return False
+                # Telnet clients end lines with CR LF or CR NUL, and
+                # the NUL is dropped on the way in
+                rest = s[end + 1:]
+                if s[end] == '\r' and rest[:1] == '\n':
+                    rest = rest[1:]
+                name = client.route_line.strip()
+                client.route_line = ''
+                self.send_buffered(client, '\r\n')
+                if name:
+                    if self.route_client(client, name, rest):
+                        return False
+                    client.route_attempts += 1
+                    if client.route_attempts >= ROUTE_ATTEMPTS:
+                        client.send_buffered(escape_iac(ROUTE_NOT_FOUND % name))
+                        self.abort_routed_client(client)
+                        return False
+                    self.send_buffered(client, escape_iac(ROUTE_NOT_FOUND % name))
+                self.send_buffered(client, ROUTE_PROMPT)
+                s = rest
+        except (EOFError, IOError, socket.error):
+            self.abort_routed_client(client)
+            return False
+        return True
+
+    def route_typed(self, client, s):
+        """
+        Add what client typed at ROUTE_PROMPT to its line, and echo it.
+        Return False if the line got too long and client was closed.
+        """
+        echo = ''
+        for c in s:
+            if c not in '\b\x7f':
+                client.route_line += c
+                echo += c
+            elif client.route_line:
+                client.route_line = client.route_line[:-1]
+                echo += '\b \b'
+        if len(client.route_line) > ROUTE_LINE_MAX:
+            self.abort_routed_client(client)
+            return False
+        self.send_buffered(client, escape_iac(echo))
+        return True
+
+    def route_client(self, client, name, typed = ''):
+        """
+        Attach client to the VM with this name or uuid, handing it to
+        the worker that serves the VM if that isn't us. typed is what
+        the client sent after naming the VM, which goes on to the VM.
+        Return False if there is no such VM.
+        """
+        uuid = self.find_vm(name)
+        if uuid is None:
+            return False
+
+        client.trace('client %s asked for %s, uuid %s', client.peer, name, uuid)
+        client.cookedq = typed + client.cookedq
+        if not self.owns_vm(uuid):
+            self.hand_off_client_connection(client, uuid)
+            return True
+
+        with self.vms_lock:
+            vm = self.vms.get(uuid)
+            if vm is None:
+                # Expired since find_vm
+                return False
+            self.attach_client(client, vm)
+        if client.cookedq:
+            self.queue_stream_task(client, self.new_client_data)
+        return True
 
     def abort_vm_connection(self, vt):
-        if vt.uuid and vt in self.vms[vt.uuid].vts:
-            logging.debug('uuid %s VM socket closed' % vt.uuid)
-            self.vms[vt.uuid].vts.remove(vt)
-            self.stamp_orphan(self.vms[vt.uuid])
-        else:
-            logging.debug('unidentified VM socket closed')
+        if not vt.sock:
+            # A hangup can be reported once more, to a task that was
+            # queued before the first one closed vt
+            return
+        with self.vms_lock:
+            if vt.uuid and vt in self.vms[vt.uuid].vts:
+                vt.trace('uuid %s VM socket closed', vt.uuid)
+                self.vms[vt.uuid].vts.remove(vt)
+                self.stamp_orphan(self.vms[vt.uuid])
+            else:
+                vt.trace('unidentified VM socket closed')
+                self.metrics.values[self.count_unidentified_vms] += 1
         self.delete_stream(vt)
         vt.close()
 
     def new_vm_data(self, vt):
+        if not vt.sock:
+            # Closed by a task that was queued before this one; a
+            # hangup is reported on every poll while reads are held off
+            return
+        if self.process_vm_data(vt):
+            if vt.uuid:
+                # From now on, keep vt's tasks in line with its VM's
+                vt.task_key = vt.uuid
+            self.resume_inline(vt, self.new_vm_data)
+            self.resume_reader(vt, self.queue_new_vm_data)
+
+    def process_vm_data(self, vt):
+        """
+        Handle what vt has to say. Return True if vt should be read
+        from again, False if it was closed or handed off.
+        """
         neg_done = False
         try:
             neg_done = vt.negotiation_done()
         except (EOFError, IOError, socket.error):
             self.abort_vm_connection(vt)
-            return
+            return False
 
         if not neg_done:
-            self.add_reader(vt, self.queue_new_vm_data)
-            return
+            self.watch_negotiation(vt, self.new_vm_data)
+            return True
 
-        # Queue VM data during vmotion
-        if vt.uuid and self.vms[vt.uuid].vmotion:
-            self.add_reader(vt, self.queue_new_vm_data)
-            return
+        if vt.uuid and not self.owns_vm(vt.uuid):
+            self.hand_off_vm_connection(vt)
+            return False
+
+        if vt.uuid:
+            with self.vms_lock:
+                if self.vms[vt.uuid].paused:
+                    self.del_reader(vt)
+                    return False
 
         s = None
         try:
             s = vt.read_very_lazy()
         except (EOFError, IOError, socket.error):
             self.abort_vm_connection(vt)
-            return
+            return False
 
         if not s: # May only be option data, or exception
-            self.add_reader(vt, self.queue_new_vm_data)
-            return
+            return True
 
         if not vt.uuid or not self.vms.has_key(vt.uuid):
             # In limbo, no one can hear you scream
-            self.add_reader(vt, self.queue_new_vm_data)
-            return
+            return True
 
-        # logging.debug('new_vm_data %s: %s' % (vt.uuid, repr(s)))
-        self.backend.notify_vm_msg(vt.uuid, vt.name, s)
+        if vt.events is not None:
+            record(vt.events, 'read %d bytes', (len(s),))
+        vm = self.vms[vt.uuid]
+        vm.output_bytes += len(s)
+        self.vm_read_sizes.observe(len(s))
+        self.vm_output(vm, s)
+        with self.vms_lock:
+            if vm.paused:
+                # Read again once resume_vm says so
+                self.del_reader(vt)
+                return False
+        return True
 
-        clients = self.vms[vt.uuid].clients[:]
-        for cl in clients:
-            try:
-                self.send_buffered(cl, s)
-            except (EOFError, IOError, socket.error), e:
-                logging.debug('cl.socket send error: %s' % (str(e)))
-                self.abort_client_connection(cl)
-        self.add_reader(vt, self.queue_new_vm_data)
+    def vm_output(self, vm, s):
+        """
+        Pass s, output of vm, on to its clients and to the backend.
+
+        If coalesce_delay is set, s may be held back and passed on along
+        with what vm outputs next. Held output is passed on once
+        coalesce_bytes are held, on the first output that comes
+        coalesce_delay or more after it, or otherwise by a timer, which
+        fires with the Poller's timer resolution. Output of a VM whose
+        clients are typing isn't held back.
+
+        While vm is being vMotioned, its output is held back until the
+        vMotion is over; see _forget_vmotion.
+        """
+        now = time.time()
+        with vm.output_lock:
+            if vm.vmotion:
+                self._hold_vm_output(vm, s)
+                return
+            if vm.held:
+                s = ''.join(vm.held) + s
+                vm.held = ()
+                vm.held_bytes = 0
+            if not s:
+                return
+
+            interactive = now < vm.last_input + INTERACTIVE_TIME
+            if not vm.pending:
+                if not self.coalesce_delay or interactive:
+                    self._emit_vm_output(vm, s)
+                    return
+                vm.pending_since = now
+                vm.pending = []
+
+            vm.pending.append(s)
+            vm.pending_bytes += len(s)
+            if interactive or vm.pending_bytes >= self.coalesce_bytes or \
+               now >= vm.pending_since + self.coalesce_delay:
+                self._flush_vm_output(vm)
+            elif vm.flush_timer is None:
+                vm.flush_timer = self.call_later(self.coalesce_delay,
+                    lambda: self.task_pool.put(vm.uuid, lambda: self.flush_vm_output(vm)))
+
+    def _hold_vm_output(self, vm, s):
+        # Callers hold vm.output_lock
+        if not vm.held:
+            vm.held = []
+        vm.held.append(s)
+        vm.held_bytes += len(s)
+        while vm.held_bytes > VMOTION_HOLD_BYTES and len(vm.held) > 1:
+            vm.held_bytes -= len(vm.held.pop(0))
+        if vm.held_bytes > VMOTION_HOLD_BYTES:
+            vm.held[0] = vm.held[0][-VMOTION_HOLD_BYTES:]
+            vm.held_bytes = len(vm.held[0])
+
+    def flush_vm_output(self, vm):
+        """
+        Pass on whatever output of vm is being held back.
+        """
+        with vm.output_lock:
+            self._flush_vm_output(vm)
+
+    def _flush_vm_output(self, vm):
+        # Callers hold vm.output_lock
+        if vm.flush_timer is not None:
+            self.cancel(vm.flush_timer)
+            vm.flush_timer = None
+        if not vm.pending:
+            return
+        s = ''.join(vm.pending)
+        vm.pending = ()
+        vm.pending_bytes = 0
+        self._emit_vm_output(vm, s)
+
+    def _emit_vm_output(self, vm, s):
+        self.backend.notify_vm_msg(vm.uuid, vm.name, s)
+        if vm.clients:
+            self.send_shared(vm, s)
+
+    def watch_negotiation(self, ts, func):
+        """
+        Arrange for func(ts) to run on the task queue once ts's option
+        negotiation times out, so that it finishes even if the peer
+        sends nothing more.
+        """
+        if ts.negotiation_timer is not None:
+            self.cancel(ts.negotiation_timer)
+            ts.negotiation_timer = None
+        if not ts.unacked:
+            return
+
+        def timeout():
+            # ts may have been closed, or negotiation may have finished
+            # and its reads moved to the reactor thread, by the time
+            # this runs
+            self.queue_stream_task(ts, lambda ts: ts.sock and not ts.inline and func(ts))
+        delay = ts.last_ack + UNACK_TIMEOUT - time.time()
+        ts.negotiation_timer = self.call_later(delay, timeout)
+
+    def resume_inline(self, ts, func):
+        """
+        Called on the task queue once a read of ts has been handled. If
+        negotiation is over and inline_data is set, ts's reads are
+        handled on the reactor thread from now on, and any pending
+        negotiation timeout is dropped.
+        """
+        if self.inline_data and not ts.unacked:
+            self.watch_negotiation(ts, func)
+            ts.inline = True
+
+    def read_inline(self, ts, process, func, abort):
+        """
+        Handle a read of ts on the reactor thread. If ts starts
+        negotiating again, its reads go back to the task queue. If
+        handling the read fails, ts is aborted from the task queue.
+        """
+        try:
+            more = process(ts)
+        except Exception:
+            # Unlike the task threads, the reactor thread isn't there to
+            # be lost to an unexpected exception
+            logging.exception("Inline read exception caught")
+            ts.inline = False
+            self.suspend_reader(ts)
+            self.queue_stream_task(ts, abort)
+            return
+        if not more:
+            return
+        if ts.unacked:
+            ts.inline = False
+        if self.edge_triggered:
+            # One-shot streams are disarmed by every event, even though
+            # we never suspended them
+            self.resume_reader(ts, func)
 
     def queue_new_vm_data(self, vt):
+        if vt.inline:
+            self.read_inline(vt, self.process_vm_data, self.queue_new_vm_data,
+                             self.abort_vm_connection)
+            return
+
         # Don't alert repeatedly on the same input
-        self.del_reader(vt)
-        self.task_queue.put(lambda: self.new_vm_data(vt))
+        self.suspend_reader(vt)
+        self.queue_stream_task(vt, self.new_vm_data)
 
     def abort_client_connection(self, client):
-        logging.debug('uuid %s client socket closed, %d active clients' %
-                      (client.uuid, len(self.vms[client.uuid].clients)-1))
-        if client in self.vms[client.uuid].clients:
-            self.vms[client.uuid].clients.remove(client)
-            self.stamp_orphan(self.vms[client.uuid])
+        with self.vms_lock:
+            vm = self.vms[client.uuid]
+            if client not in vm.clients:
+                # Aborted already, by a task queued before this one
+                # (a hung up socket is reported until it is deleted)
+                return
+            client.trace('uuid %s client socket closed, %d active clients',
+                         client.uuid, len(vm.clients) - 1)
+            vm.clients.remove(client)
+            self.metrics.values[self.count_detaches] += 1
+            self.stamp_orphan(vm)
+            if client in vm.parked:
+                vm.parked.remove(client)
         self.delete_stream(client)
+        client.drop_send_queue()
+        if vm.paused:
+            self.resume_vm(vm)
         self.backend.notify_client_del(client.sock, client.uuid)
 
     def new_client_data(self, client):
+        if not client.sock:
+            # Closed meanwhile; see new_vm_data
+            return
+        if self.process_client_data(client):
+            self.resume_inline(client, self.new_client_data)
+            self.resume_reader(client, self.queue_new_client_data)
+
+    def process_client_data(self, client):
+        """
+        Pass what client typed on to its VM. Return True if client
+        should be read from again, False if it was closed.
+        """
         neg_done = False
         try:
             neg_done = client.negotiation_done()
         except (EOFError, IOError, socket.error):
             self.abort_client_connection(client)
-            return
+            return False
 
         if not neg_done:
-            self.add_reader(client, self.queue_new_client_data)
-            return
+            self.watch_negotiation(client, self.new_client_data)
+            return True
 
-        # Queue VM data during vmotion
-        if self.vms[client.uuid].vmotion:
-            self.add_reader(client, self.queue_new_client_data)
-            return
+        vm = self.vms[client.uuid]
+        with self.vms_lock:
+            if vm.vmotion:
+                # Leave client's input be until the vMotion is over; see
+                # _forget_vmotion
+                self.suspend_reader(client)
+                if not vm.parked:
+                    vm.parked = []
+                vm.parked.append(client)
+                return False
 
         s = None
         try:
             s = client.read_very_lazy()
         except (EOFError, IOError, socket.error):
             self.abort_client_connection(client)
-            return
+            return False
 
         if not s: # May only be option data, or exception
-            self.add_reader(client, self.queue_new_client_data)
-            return
+            return True
+
+        if client.events is not None:
+            record(client.events, 'read %d bytes', (len(s),))
 
-        # logging.debug('new_client_data %s: %s' % (client.uuid, repr(s)))
+        vm.last_input = time.time()
+        vm.input_bytes += len(s)
+        if vm.pending:
+            # What the VM said before this goes out before any echo
+            self.flush_vm_output(vm)
 
-        for vt in self.vms[client.uuid].vts:
+        for vt in vm.vts[:]:
             try:
                 self.send_buffered(vt, s)
             except (EOFError, IOError, socket.error), e:
-                logging.debug('cl.socket send error: %s' % (str(e)))
-        self.add_reader(client, self.queue_new_client_data)
+                vt.trace('send error: %s', e)
+        return True
 
     def queue_new_client_data(self, client):
+        if client.inline:
+            self.read_inline(client, self.process_client_data,
+                             self.queue_new_client_data,
+                             self.abort_client_connection)
+            return
+
         # Don't alert repeatedly on the same input
-        self.del_reader(client)
-        self.task_queue.put(lambda: self.new_client_data(client))
+        self.suspend_reader(client)
+        self.queue_stream_task(client, self.new_client_data)
+
+    def find_vm(self, name):
+        """
+        Return the uuid of the VM with this name or uuid, or None if
+        there isn't one. If several VMs have the name, the one that
+        took it last wins.
+        """
+        with self.vms_lock:
+            if name in self.vm_uuids:
+                return name
+            return self.vm_names.get(name)
+
+    def index_vm(self, uuid, name):
+        # Callers hold vms_lock
+        self.unindex_vm(uuid)
+        self.vm_uuids[uuid] = name
+        if name:
+            self.vm_names[name] = uuid
+
+    def unindex_vm(self, uuid):
+        # Callers hold vms_lock
+        name = self.vm_uuids.pop(uuid, None)
+        if name and self.vm_names.get(name) == uuid:
+            del self.vm_names[name]
 
     def new_vm(self, uuid, name, port = None, vts = None):
-        vm = self.Vm(uuid = uuid, name = name, vts = vts)
+        with self.vms_lock:
+            vm = self.Vm(uuid = uuid, name = name, vts = vts)
 
-        self.open_vm_port(vm, port)
-        self.vms[uuid] = vm
+            self.open_vm_port(vm, port)
+            self.vms[uuid] = vm
+            self.index_vm(uuid, name)
 
-        # Only notify if we generated the port
-        if not port:
-            self.backend.notify_vm(vm.uuid, vm.name, vm.port)
+            # Only notify if we generated the port
+            if vm.port != port:
+                self.backend.notify_vm(vm.uuid, vm.name, vm.port)
+            self._announce_vm(vm)
 
-        logging.debug('%s:%s connected' % (vm.uuid, repr(vm.name)))
-        if vm.port is not None:
-            logging.debug("listening on port %d" % vm.port)
+            logging.debug('%s:%r connected', vm.uuid, vm.name)
+            if vm.port is not None:
+                logging.debug("listening on port %d", vm.port)
 
-        # The clock is always ticking
-        self.stamp_orphan(vm)
+            # The clock is always ticking
+            self.stamp_orphan(vm)
 
-        return vm
+            return vm
 
     def _add_vm_when_ready(self, vt):
         if not vt.name or not vt.uuid:
             return
 
+        if not self.owns_vm(vt.uuid):
+            # Handed off to the owning worker once negotiation is done
+            return
+
         self.new_vm(vt.uuid, vt.name, vts = [vt])
 
     def handle_vc_uuid(self, vt):
-        if not self.vms.has_key(vt.uuid):
-            self._add_vm_when_ready(vt)
-            return
-
-        # This could be a reconnect, or it could be a vmotion
-        # peer. Regardless, it's easy enough just to allow this
-        # new vt to send to all clients, and all clients to
-        # receive.
-        vm = self.vms[vt.uuid]
-        vm.vts.append(vt)
+        with self.vms_lock:
+            if not self.vms.has_key(vt.uuid):
+                self._add_vm_when_ready(vt)
+                return
+
+            # This could be a reconnect, or it could be a vmotion
+            # peer. Regardless, it's easy enough just to allow this
+            # new vt to send to all clients, and all clients to
+            # receive.
+            vm = self.vms[vt.uuid]
+            vm.vts.append(vt)
+            self.unstamp_orphan(vm)
+            if vm.listener is None and self.port_allocator is not None:
+                self.bind_restored_vm(vm, vm.port)
 
-        logging.debug('uuid %s VM reconnect, %d active' %
-                      (vm.uuid, len(vm.vts)))
+            vt.trace('uuid %s VM reconnect, %d active', vm.uuid, len(vm.vts))
 
     def handle_vm_name(self, vt):
-        if not self.vms.has_key(vt.uuid):
-            self._add_vm_when_ready(vt)
-            return
+        with self.vms_lock:
+            if not self.vms.has_key(vt.uuid):
+                self._add_vm_when_ready(vt)
+                return
 
-        vm = self.vms[vt.uuid]
-        if vt.name != vm.name:
-            vm.name = vt.name
-            self.backend.notify_vm(vm.uuid, vm.name, vm.port)
+            vm = self.vms[vt.uuid]
+            if vt.name != vm.name:
+                vm.name = vt.name
+                self.index_vm(vm.uuid, vm.name)
+                self.backend.notify_vm(vm.uuid, vm.name, vm.port)
+                self._announce_vm(vm)
 
     def handle_vmotion_begin(self, vt, data):
-        if not vt.uuid:
-            # No Vm structure created yet
-            return False
+        with self.vms_lock:
+            if not vt.uuid:
+                # No Vm structure created yet
+                return False
 
-        vm = self.vms[vt.uuid]
-        if vm.vmotion:
-            return False
+            vm = self.vms[vt.uuid]
+            if vm.vmotion:
+                return False
 
-        vm.vmotion = data
-        self.vmotions[data] = vt.uuid
+            vm.vmotion = data
+            self.vmotions[data] = vt.uuid
+            if self.shards is not None:
+                self.shards.broadcast(('vmotion_begin', data, vt.uuid))
 
-        return True
+            return True
 
     def handle_vmotion_peer(self, vt, data):
-        if not self.vmotions.has_key(data):
-            logging.debug('peer cookie %s doesn\'t exist' % hexdump(data))
-            return False
+        with self.vms_lock:
+            if self.remote_vmotions.has_key(data):
+                # The vmotion began in another worker. Accept the peer here;
+                # it is handed off to that worker once negotiation is done.
+                peer_uuid = self.remote_vmotions[data]
+                vt.trace('peer cookie %s maps to uuid %s in another worker',
+                         lazy(hexdump, data), peer_uuid)
+                if vt.uuid and vt.uuid != peer_uuid:
+                    return False
+                vt.uuid = peer_uuid
+                return True
+
+            if not self.vmotions.has_key(data):
+                vt.trace('peer cookie %s doesn\'t exist', lazy(hexdump, data))
+                return False
 
-        logging.debug('peer cookie %s maps to uuid %s' %
-                      (hexdump(data), self.vmotions[data]))
+            vt.trace('peer cookie %s maps to uuid %s', lazy(hexdump, data), self.vmotions[data])
 
-        peer_uuid = self.vmotions[data]
-        if vt.uuid:
-            vm = self.vms[vt.uuid]
-            if vm.uuid != peer_uuid:
-                logging.debug('peer uuid %s != other uuid %s' % hexdump(data))
-                return False
-            return True # vt already in place
-        else:
-            # Act like we just learned the uuid
-            vt.uuid = peer_uuid
-            self.handle_vc_uuid(vt)
+            peer_uuid = self.vmotions[data]
+            if vt.uuid:
+                vm = self.vms[vt.uuid]
+                if vm.uuid != peer_uuid:
+                    vt.trace('peer uuid %s != other uuid %s', peer_uuid, vm.uuid)
+                    return False
+                return True # vt already in place
+            else:
+                # Act like we just learned the uuid
+                vt.uuid = peer_uuid
+                self.handle_vc_uuid(vt)
 
-        return True
+            return True
 
     def handle_vmotion_complete(self, vt):
-        logging.debug('uuid %s vmotion complete' % vt.uuid)
-        vm = self.vms[vt.uuid]
+        vt.trace('uuid %s vmotion complete', vt.uuid)
+        with self.vms_lock:
+            if not self.owns_vm(vt.uuid):
+                self.shards.send(self.shards.owner(vt.uuid), ('vmotion_done', vt.uuid))
+                return
+            vm = self.vms[vt.uuid]
+            self._forget_vmotion(vm)
+
+    def handle_vmotion_abort(self, vt):
+        vt.trace('uuid %s vmotion abort', vt.uuid)
+        with self.vms_lock:
+            if not self.owns_vm(vt.uuid):
+                self.shards.send(self.shards.owner(vt.uuid), ('vmotion_done', vt.uuid))
+                return
+            vm = self.vms[vt.uuid]
+            if vm.vmotion:
+                self._forget_vmotion(vm)
+
+    def _forget_vmotion(self, vm):
         del self.vmotions[vm.vmotion]
+        if self.shards is not None:
+            self.shards.broadcast(('vmotion_end', vm.vmotion))
         vm.vmotion = None
 
-    def handle_vmotion_abort(self, vt):
-        logging.debug('uuid %s vmotion abort' % vt.uuid)
-        vm = self.vms[vt.uuid]
-        if vm.vmotion:
-            del self.vmotions[vm.vmotion]
-            vm.vmotion = None
+        # Pass on what the VM said during the vMotion, and go back to
+        # reading its clients
+        self.task_pool.put(vm.uuid, lambda: self.vm_output(vm, ''))
+        for client in vm.parked:
+            self.queue_stream_task(client, self.new_client_data)
+        vm.parked = ()
 
     def check_orphan(self, vm):
         return len(vm.vts) == 0 and len(vm.clients) == 0
 
     def stamp_orphan(self, vm):
-        if self.check_orphan(vm):
-            self.orphans.append(vm.uuid)
+        with self.vms_lock:
+            if not self.check_orphan(vm):
+                return
+            self.unstamp_orphan(vm)
             vm.last_time = time.time()
+            entry = [vm.last_time + self.vm_expire_time, vm.uuid, True]
+            self.orphan_entries[vm.uuid] = entry
+            heapq.heappush(self.orphans, entry)
+            if self.orphans[0] is entry:
+                self._schedule_orphan_expiry()
+
+    def unstamp_orphan(self, vm):
+        """
+        Called when vm gets a connection, so it won't be expired.
+        """
+        with self.vms_lock:
+            entry = self.orphan_entries.pop(vm.uuid, None)
+            if entry is None:
+                return
+            entry[2] = False
+            if len(self.orphans) > 2 * len(self.orphan_entries) + 64:
+                # Mostly invalid entries; don't let them pile up
+                self.orphans = [e for e in self.orphans if e[2]]
+                heapq.heapify(self.orphans)
+
+    def _schedule_orphan_expiry(self):
+        """
+        Arrange for collect_orphans to run when the first orphan is due
+        to expire.
+        """
+        # Callers hold vms_lock
+        if self.orphan_timer is not None:
+            self.cancel(self.orphan_timer)
+            self.orphan_timer = None
+        while self.orphans and not self.orphans[0][2]:
+            heapq.heappop(self.orphans)
+        if self.orphans:
+            self.orphan_timer = self.call_later(self.orphans[0][0] - time.time(),
+                lambda: self.task_pool.put(None, self.collect_orphans))
+
+    def orphan_stats(self):
+        """
+        Return the number of VMs without connections, and the number of
+        VMs expired so far.
+        """
+        with self.vms_lock:
+            return {
+                'orphans': len(self.orphan_entries),
+                'expired': self.orphans_expired,
+            }
 
     def new_admin_connection(self, sock):
-        self.collect_orphans()
         self.backend.notify_query_socket(sock, self)
 
     def queue_new_admin_connection(self, listener):
-        sock = listener.accept()[0]
-        self.task_queue.put(lambda: self.new_admin_connection(sock))
+        for sock in accept_all(listener):
+            self.task_pool.put(None, lambda sock = sock: self.new_admin_connection(sock))
 
     def new_admin_client_connection(self, sock, uuid, readonly):
         client = self.Client(sock)
         client.uuid = uuid
+        client.task_key = uuid
+        self.setup_stream(client)
 
         vm = self.vms[uuid]
 
         if not readonly:
-            self.add_reader(client, self.queue_new_client_data)
-        vm.clients.append(client)
+            self.add_reader(client, self.queue_new_client_data, oneshot = True)
+            self.watch_negotiation(client, self.new_client_data)
+        with self.vms_lock:
+            vm.clients.append(client)
+            self.unstamp_orphan(vm)
+        if vm.paused:
+            self.resume_vm(vm)
 
-        logging.debug('uuid %s new client, %d active clients'
-                      % (client.uuid, len(vm.clients)))
+        client.trace('uuid %s new client, %d active clients', client.uuid, len(vm.clients))
 
     def queue_new_admin_client_connection(self, sock, uuid, readonly):
-        self.task_queue.put(lambda: self.new_admin_client_connection(sock, uuid, readonly))
+        self.task_pool.put(uuid, lambda: self.new_admin_client_connection(sock, uuid, readonly))
 
     def collect_orphans(self):
-        t = time.time()
-
-        orphans = self.orphans[:]
-        for uuid in orphans:
-            if not self.vms.has_key(uuid):
-                self.orphans.remove(uuid)
-                continue
-            vm = self.vms[uuid]
+        """
+        Expire the VMs that have been without connections for
+        vm_expire_time, up to ORPHAN_BATCH of them.
+        """
+        with self.vms_lock:
+            t = time.time()
+
+            expired = 0
+            while self.orphans and self.orphans[0][0] <= t and expired < ORPHAN_BATCH:
+                (expire_time, uuid, valid) = heapq.heappop(self.orphans)
+                if not valid:
+                    continue
+                del self.orphan_entries[uuid]
+                vm = self.vms.get(uuid)
+                if vm is None or not self.check_orphan(vm):
+                    continue
+                self.expire_vm(vm)
+                expired += 1
+
+            if self.orphans and self.orphans[0][0] <= t:
+                # Let other tasks have a turn before doing the rest
+                self.task_pool.put(None, self.collect_orphans)
+            else:
+                self._schedule_orphan_expiry()
+
+    def expire_vm(self, vm):
+        # Callers hold vms_lock
+        logging.debug('expired VM with uuid %s, port %s', vm.uuid, vm.port)
+        self.orphans_expired += 1
+        self.backend.notify_vm_del(vm.uuid)
+        self._announce_vm_del(vm.uuid)
+
+        if vm.listener is not None:
+            self.delete_stream(vm)
+            vm.listener.close()
+            vm.listener = None
+        if vm.port is not None:
+            self.port_allocator.free_port(vm.port)
+        del self.vms[vm.uuid]
+        self.unindex_vm(vm.uuid)
+        if vm.vmotion:
+            self._forget_vmotion(vm)
 
-            if not self.check_orphan(vm):
-                self.orphans.remove(uuid) # Orphan no longer
-                continue
-            elif vm.last_time + self.vm_expire_time > t:
-                continue
+    def open_vm_port(self, vm, port):
+        """
+        Start listening for vm's clients, on port if it's given and
+        free, or else on a port from port_allocator.
+        """
+        if self.port_allocator is None:
+            return
 
-            logging.debug('expired VM with uuid %s' % uuid)
-            if vm.port is not None:
-                logging.debug(", port %d" % vm.port)
-            self.backend.notify_vm_del(vm.uuid)
+        self.reserve_vm_port(vm, port)
+        self.bind_vm_port(vm)
 
-            self.delete_stream(vm)
-            del vm.listener
-            if self.vm_port_next is not None:
-                self.vm_port_next = min(vm.port, self.vm_port_next)
-                del self.ports[vm.port]
-            del self.vms[uuid]
-            if vm.vmotion:
-                del self.vmotions[vm.vmotion]
-                vm.vmotion = None
-            del vm
+    def reserve_vm_port(self, vm, port):
+        """
+        Set aside port for vm, if it's given and free, so that vm can
+        listen on it later; see bind_vm_port.
+        """
+        # Callers hold vms_lock
+        if not port:
+            return
+        if port in self.port_allocator.owners:
+            logging.warning('uuid %s: port %d is taken, allocating another'
+                            % (vm.uuid, port))
+        else:
+            self.port_allocator.reserve(port, vm.uuid)
+            vm.port = port
 
-    def open_vm_port(self, vm, port):
-        self.collect_orphans()
+    def bind_vm_port(self, vm):
+        """
+        Start listening for vm's clients, on the port reserved for it if
+        there is one and we can, or else on a port from port_allocator.
+        """
+        # Callers hold vms_lock
+        if vm.listener is not None:
+            return
 
-        if self.vm_port_next is None:
+        if vm.port is not None:
+            try:
+                vm.listener = openport(vm.port, self.vm_iface)
+            except socket.error, e:
+                logging.warning('uuid %s: can\'t listen on port %d (%s), '
+                                'allocating another' % (vm.uuid, vm.port, e))
+                self.port_allocator.skip(vm.port)
+                vm.port = None
+
+        # Ports we couldn't bind are only given back once we're done,
+        # so that we don't get them again right away
+        skipped = []
+        try:
+            while vm.listener is None and len(skipped) < PORT_BIND_RETRIES:
+                p = self.port_allocator.allocate(vm.uuid)
+                if p is None:
+                    break
+                try:
+                    vm.listener = openport(p, self.vm_iface)
+                    vm.port = p
+                except socket.error, e:
+                    logging.warning('uuid %s: can\'t listen on port %d (%s)'
+                                    % (vm.uuid, p, e))
+                    skipped.append(p)
+        finally:
+            for p in skipped:
+                self.port_allocator.skip(p)
+
+        if vm.listener is None:
+            logging.error('uuid %s: no port to listen for clients on' % vm.uuid)
             return
+        self.add_reader(vm, self.queue_new_client_connection)
 
-        if port:
-            vm.port = port
+    def create_old_vms(self, vms):
+        """
+        Recreate the VMs the backend knew about when we last ran, in
+        one go. Their old ports are set aside for them, but they start
+        listening on them a batch at a time afterwards, see
+        bind_restored_vms, so that VMs connecting meanwhile are served.
+        """
+        start = time.time()
+        restored = []
+        with self.vms_lock:
+            t = time.time()
+            for ovm in vms:
+                if not self.owns_vm(ovm.uuid):
+                    if ovm.port is not None and self.port_allocator is not None and \
+                       ovm.port not in self.port_allocator.owners:
+                        # Keep another worker's port out of our allocations
+                        self.port_allocator.reserve(ovm.port, ovm.uuid)
+                    continue
+
+                vm = self.Vm(uuid = ovm.uuid, name = ovm.name)
+                if self.port_allocator is not None:
+                    self.reserve_vm_port(vm, ovm.port)
+                self.vms[vm.uuid] = vm
+                self.index_vm(vm.uuid, vm.name)
+                self._announce_vm(vm)
+
+                # As stamp_orphan, but heapified once at the end
+                vm.last_time = t
+                entry = [t + self.vm_expire_time, vm.uuid, True]
+                self.orphan_entries[vm.uuid] = entry
+                self.orphans.append(entry)
+                restored.append((vm, ovm.port))
+
+            heapq.heapify(self.orphans)
+            self._schedule_orphan_expiry()
+
+        logging.info('Restored %d VMs in %.3fs' % (len(restored), time.time() - start))
+        if self.port_allocator is not None and restored:
+            self.unbound_vms.extend(restored)
+            self.task_pool.put(None, self.bind_restored_vms)
+
+    def bind_restored_vms(self):
+        """
+        Start listening for the clients of up to RESTORE_BIND_BATCH of
+        the VMs restored by create_old_vms, then leave the rest to
+        another task.
+        """
+        with self.vms_lock:
+            for i in range(min(RESTORE_BIND_BATCH, len(self.unbound_vms))):
+                (vm, port) = self.unbound_vms.popleft()
+                if self.vms.get(vm.uuid) is vm:
+                    self.bind_restored_vm(vm, port)
+            done = not self.unbound_vms
+
+        if done:
+            logging.info('Listening for the clients of all restored VMs, %.3fs after startup'
+                         % (time.time() - self.start_time))
         else:
-            p = self.vm_port_next
-            while self.ports.has_key(p):
-                p += 1
+            self.task_pool.put(None, self.bind_restored_vms)
+
+    def bind_restored_vm(self, vm, port):
+        """
+        Start listening for the clients of vm, restored by
+        create_old_vms with port, if it isn't yet. This is done as soon
+        as vm connects, rather than waiting for its turn.
+        """
+        # Callers hold vms_lock
+        if vm.listener is not None:
+            return
+        self.bind_vm_port(vm)
+        if vm.port != port:
+            self.backend.notify_vm(vm.uuid, vm.name, vm.port)
+            self._announce_vm(vm)
 
-            self.vm_port_next = p + 1
-            vm.port = p
+    def owns_vm(self, uuid):
+        """
+        Return True if VMs with this uuid are served by this process.
+        """
+        return self.shards is None or self.shards.is_local(uuid)
 
-        assert not self.ports.has_key(vm.port)
-        self.ports[vm.port] = vm.uuid
+    def _announce_vm(self, vm):
+        if self.shards is not None:
+            self.shards.broadcast(('vm', vm.uuid, vm.name, vm.port))
 
-        vm.listener = openport(vm.port, self.vm_iface)
-        self.add_reader(vm, self.queue_new_client_connection)
+    def _announce_vm_del(self, uuid):
+        if self.shards is not None:
+            self.shards.broadcast(('vm_del', uuid))
 
-    def create_old_vms(self, vms):
+    def hand_off_vm_connection(self, vt):
+        owner = self.shards.owner(vt.uuid)
+        vt.trace('uuid %s belongs to worker %d, handing off VM connection', vt.uuid, owner)
+        self.delete_stream(vt)
+        # Whatever we read past negotiation goes along with the socket
+        raw = vt.rawq[vt.irawq:]
+        sock = socket.fromfd(vt.sock.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        self.shards.send(owner, ('vm_connection', vt.uuid, vt.name, vt.cookedq, raw),
+                         sock)
+        vt.close()
+
+    def hand_off_client_connection(self, client, uuid):
+        owner = self.shards.owner(uuid)
+        client.trace('uuid %s belongs to worker %d, handing off client connection',
+                     uuid, owner)
+        self.delete_stream(client)
+        # As for VM connections, what we read past negotiation goes along
+        raw = client.rawq[client.irawq:]
+        sock = socket.fromfd(client.sock.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        self.shards.send(owner, ('client_connection', uuid, client.cookedq, raw), sock)
+        client.close()
+
+    def forward_admin_query(self, sock, uuid, vm_name, lock_mode):
+        owner = self.shards.owner(uuid)
+        logging.debug('uuid %s belongs to worker %d, handing off admin query', uuid, owner)
+        sock = socket.fromfd(sock.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        self.shards.send(owner, ('admin_query', vm_name, lock_mode), sock)
+
+    def queue_new_shard_message(self, channel):
+        try:
+            (msg, sock) = self.shards.recv(channel)
+        except (EOFError, IOError, socket.error), e:
+            logging.error('lost contact with another vSPC worker: %s' % e)
+            self.delete_stream(channel)
+            return
+
+        # Messages from each peer are handled in the order it sent them
+        self.task_pool.put(channel, lambda: self.new_shard_message(msg, sock))
+
+    def new_shard_message(self, msg, sock):
+        getattr(self, '_handle_shard_%s' % msg[0])(sock, *msg[1:])
+
+    def _handle_shard_vm_connection(self, sock, uuid, name, cooked, raw):
+        sock.setblocking(0)
+        vt = VMTelnetServer(sock, handler = self, negotiate = False)
+        self.setup_stream(vt)
+        vt.uuid = uuid
+        vt.name = name
+        vt.task_key = uuid
+        vt.cookedq = cooked
+        vt.rawq = raw
+        self.handle_vc_uuid(vt)
+        self.handle_vm_name(vt)
+        self.add_reader(vt, self.queue_new_vm_data, oneshot = True)
+        if cooked or raw:
+            self.queue_stream_task(vt, self.new_vm_data)
+
+    def _handle_shard_client_connection(self, sock, uuid, cooked, raw):
+        sock.setblocking(0)
+        client = self.Client(sock, negotiate = False)
+        self.setup_stream(client)
+        client.cookedq = cooked
+        client.rawq = raw
+        with self.vms_lock:
+            vm = self.vms.get(uuid)
+            if vm is None:
+                logging.debug('uuid %s handed a client, but it has expired', uuid)
+                client.send_buffered(ROUTE_NOT_FOUND % uuid)
+                client.close()
+                return
+            self.attach_client(client, vm)
+        if cooked or raw:
+            self.queue_stream_task(client, self.new_client_data)
+
+    def _handle_shard_admin_query(self, sock, vm_name, lock_mode):
+        self.backend.notify_query_forwarded(sock, self, vm_name, lock_mode)
+
+    def _handle_shard_vm(self, sock, uuid, name, port):
+        with self.vms_lock:
+            self.index_vm(uuid, name)
+        self.backend.notify_remote_vm(uuid, name, port)
+
+    def _handle_shard_vm_del(self, sock, uuid):
+        with self.vms_lock:
+            self.unindex_vm(uuid)
+        self.backend.notify_remote_vm_del(uuid)
+
+    def _handle_shard_vmotion_begin(self, sock, cookie, uuid):
+        with self.vms_lock:
+            self.remote_vmotions[cookie] = uuid
+
+    def _handle_shard_vmotion_end(self, sock, cookie):
+        with self.vms_lock:
+            self.remote_vmotions.pop(cookie, None)
+
+    def _handle_shard_vmotion_done(self, sock, uuid):
+        with self.vms_lock:
+            vm = self.vms.get(uuid)
+            if vm is not None and vm.vmotion:
+                self._forget_vmotion(vm)
+
+    def dump_events(self, uuid = None):
+        """
+        Log the recent events of the connections of the VM with the
+        given uuid, or of every VM, at INFO. Takes no locks, so that it
+        can be called from a signal handler; what is logged may be a
+        little out of date.
+        """
+        if not self.trace_events:
+            logging.info('no events to dump; start vSPC with --trace-events')
+            return
+        if uuid is None:
+            vms = self.vms.values()
+        else:
+            vms = filter(None, [self.vms.get(uuid)])
         for vm in vms:
-            self.new_vm(uuid = vm.uuid, name = vm.name, port = vm.port)
+            streams = [('VM connection', vt) for vt in list(vm.vts)]
+            streams += [('client %s' % cl.peer, cl) for cl in list(vm.clients)]
+            for (what, ts) in streams:
+                if not ts.events:
+                    continue
+                logging.info('uuid %s %s events:', vm.uuid, what)
+                for line in format_events(ts.events):
+                    logging.info('  %s', line)
 
     def run(self):
+        self.start_time = time.time()
         logging.info('Starting vSPC on proxy iface %s port %d, admin iface %s port %d' %
                      (self.proxy_iface, self.proxy_port, self.admin_iface, self.admin_port))
-        if self.vm_port_next is not None:
-            logging.info("Allocating VM ports starting at %d on interface %s" % (self.vm_port_next, self.vm_iface) )
+        if self.shards is not None:
+            logging.info("Running as worker %d of %d" % (self.shards.index, self.shards.count))
+            for channel in self.shards.channels.values():
+                self.add_reader(channel, self.queue_new_shard_message)
+        if self.port_allocator is not None:
+            logging.info("Allocating VM ports from %d to %d on interface %s" %
+                         (self.port_allocator.start, self.port_allocator.end, self.vm_iface))
+
+        reuse_port = self.shards is not None
+        backlog = self.listen_backlog
+        self.add_reader(openport(self.proxy_port, self.proxy_iface, reuse_port, backlog),
+                        self.queue_new_vm_connection)
+        self.add_reader(openport(self.admin_port, self.admin_iface, reuse_port, backlog),
+                        self.queue_new_admin_connection)
+        if self.client_port is not None:
+            logging.info("Listening for clients of all VMs on interface %s port %d" %
+                         (self.vm_iface, self.client_port))
+            self.add_reader(openport(self.client_port, self.vm_iface, reuse_port, backlog),
+                            self.queue_new_routed_client_connection)
+        if self.metrics_port is not None:
+            # One port for each worker, as each has metrics of its own
+            port = self.metrics_port
+            if self.shards is not None:
+                port += self.shards.index
+            logging.info("Serving metrics on interface %s port %d", self.metrics_iface, port)
+            start_http(openport(port, self.metrics_iface, False, backlog), self.metrics)
+        self.start()
 
+        # Only once we're listening, so that VMs connecting meanwhile
+        # wait in the listen queue rather than being refused
         self.create_old_vms(self.backend.get_observed_vms())
-
-        self.add_reader(openport(self.proxy_port, self.proxy_iface, self.do_ssl, self.ssl_cert, self.ssl_key), self.queue_new_vm_connection)
-        self.add_reader(openport(self.admin_port, self.admin_iface), self.queue_new_admin_connection)
-        self.start()
         self.run_forever()
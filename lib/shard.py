@@ -0,0 +1,173 @@
+# vSPC/shard.py -- support for running vSPC as several sharded processes
+
+import logging
+import os
+import pickle
+import signal
+import socket
+import struct
+import threading
+import zlib
+import Queue
+
+from _multiprocessing import sendfd, recvfd
+
+# Message header: body length, followed by a flag saying whether a file
+# descriptor follows the body.
+HEADER = struct.Struct("!IB")
+
+def shard_for_uuid(uuid, count):
+    """
+    Map a VM uuid onto one of count shards. This must give the same
+    answer in every process, so it can't use hash().
+    """
+    return (zlib.crc32(uuid) & 0xffffffff) % count
+
+def _recv_exactly(sock, n):
+    data = ''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError("peer vSPC process went away")
+        data += chunk
+    return data
+
+class ShardSet:
+    """
+    I describe the shard owned by this process, and know how to talk to
+    the processes that own the other shards.
+
+    Every pair of processes shares a Unix socketpair. Messages are
+    pickled tuples whose first element names the message type, and may
+    carry a socket, which is passed to the peer process with SCM_RIGHTS.
+    Sends are done by a dedicated thread, so callers never block on a
+    peer that is busy.
+    """
+    def __init__(self, index, count, channels):
+        self.index = index
+        self.count = count
+        # peer index => our end of the socketpair shared with that peer
+        self.channels = channels
+
+        self.send_queue = Queue.Queue()
+        th = threading.Thread(target = self.send_run)
+        th.daemon = True
+        th.start()
+
+    def owner(self, uuid):
+        return shard_for_uuid(uuid, self.count)
+
+    def is_local(self, uuid):
+        return self.owner(uuid) == self.index
+
+    def send(self, peer, msg, sock = None):
+        """
+        Queue msg for delivery to peer. If sock is given, it is passed
+        along with the message and closed here once it has been sent.
+        """
+        self.send_queue.put((peer, msg, sock))
+
+    def broadcast(self, msg):
+        for peer in self.channels:
+            self.send(peer, msg)
+
+    def send_run(self):
+        while True:
+            (peer, msg, sock) = self.send_queue.get()
+            try:
+                body = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+                channel = self.channels[peer]
+                channel.sendall(HEADER.pack(len(body), sock is not None) + body)
+                if sock is not None:
+                    sendfd(channel.fileno(), sock.fileno())
+            except Exception, e:
+                logging.exception("failed to send %s to vSPC process %d" %
+                                  (msg[0], peer))
+            if sock is not None:
+                sock.close()
+
+    def recv(self, channel):
+        """
+        Read one message from channel. Return the message and the passed
+        socket, if any.
+        """
+        (length, has_sock) = HEADER.unpack(_recv_exactly(channel, HEADER.size))
+        msg = pickle.loads(_recv_exactly(channel, length))
+        sock = None
+        if has_sock:
+            fd = recvfd(channel.fileno())
+            # fromfd gives us a bare _socket.socket; wrap it so that it
+            # behaves like the sockets accept() gives us (e.g. makefile)
+            sock = socket.socket(_sock = socket.fromfd(fd, socket.AF_INET,
+                                                       socket.SOCK_STREAM))
+            os.close(fd)
+        return (msg, sock)
+
+def fork_workers(count, run):
+    """
+    Fork count worker processes, calling run with a ShardSet in each of
+    them, then wait for them in the parent. Termination signals sent to
+    the parent are passed on to the workers, as are SIGHUP, SIGUSR1 and
+    SIGUSR2. If a worker
+    dies, the others are stopped too.
+    """
+    channels = {}
+    for src in range(count):
+        for dst in range(src + 1, count):
+            (a, b) = socket.socketpair()
+            channels[(src, dst)] = a
+            channels[(dst, src)] = b
+
+    pids = {}
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            mine = {}
+            for (src, dst), sock in channels.items():
+                if src == index:
+                    mine[dst] = sock
+                else:
+                    sock.close()
+            status = 0
+            try:
+                run(ShardSet(index, count, mine))
+            except KeyboardInterrupt:
+                pass
+            except Exception, e:
+                logging.exception("Worker %d: top level exception caught" % index)
+                status = 1
+            os._exit(status)
+        pids[pid] = index
+
+    for sock in channels.values():
+        sock.close()
+
+    stopping = []
+
+    def forward(signum, frame):
+        if signum not in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+            stopping.append(signum)
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, forward)
+
+    result = 0
+    while pids:
+        try:
+            (pid, status) = os.wait()
+        except OSError:
+            # interrupted by a forwarded signal
+            continue
+        index = pids.pop(pid, None)
+        if index is not None and not stopping:
+            logging.error("vSPC worker %d exited with status %d, stopping "
+                          "the others" % (index, status))
+            result = 1
+            forward(signal.SIGTERM, None)
+
+    return result
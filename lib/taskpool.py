@@ -0,0 +1,131 @@
+# vSPC/taskpool.py -- a thread pool that keeps tasks in order by key
+
+import collections
+import logging
+import threading
+
+class TaskPool:
+    """
+    I run tasks on a pool of threads.
+
+    Each task is put with a key. Tasks with the same key run one at a
+    time, in the order they were put; tasks with different keys (or no
+    key at all) may run in parallel. vSPC uses VM uuids as keys, so a
+    VM's output and its clients' input are handled in order, but a slow
+    VM doesn't hold up the others.
+
+    The pool starts with min_threads threads, and starts another one,
+    up to max_threads, whenever more keys are waiting for a thread than
+    there are idle threads.
+    Threads that stay idle are retired again by trim, which the owner
+    is expected to call periodically.
+    """
+    def __init__(self, min_threads = 1, max_threads = 4):
+        assert 1 <= min_threads <= max_threads
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # Keys with tasks waiting for a thread
+        self.ready = collections.deque()
+        # key => deque of tasks, for every key that is ready or running
+        self.chains = {}
+
+        self.threads = 0
+        self.idle = 0
+        # Fewest idle threads seen since the last trim
+        self.idle_low = 0
+        # Idle threads asked to exit by trim
+        self.retiring = 0
+
+    def start(self):
+        with self.lock:
+            for i in range(self.min_threads):
+                self._start_thread()
+
+    def _start_thread(self):
+        # Callers hold self.lock
+        self.threads += 1
+        th = threading.Thread(target = self.run, name = 'task')
+        th.daemon = True
+        th.start()
+
+    def put(self, key, func):
+        """
+        Queue func to run after every task already put with key. A key
+        of None puts func in line by itself.
+        """
+        with self.lock:
+            if key is None:
+                key = object()
+            chain = self.chains.get(key)
+            if chain is not None:
+                # Picked up by the thread running key, or when key's
+                # turn in self.ready comes
+                chain.append(func)
+                return
+
+            self.chains[key] = collections.deque([func])
+            self.ready.append(key)
+            if self.idle:
+                self.cond.notify()
+            if len(self.ready) > self.idle and self.threads < self.max_threads:
+                self._start_thread()
+
+    def depth(self):
+        """
+        Return the number of tasks waiting to run.
+        """
+        with self.lock:
+            return sum(len(c) for c in self.chains.values())
+
+    def trim(self):
+        """
+        Retire the threads beyond min_threads that stayed idle since the
+        last call.
+        """
+        with self.lock:
+            surplus = min(self.idle_low, self.threads - self.min_threads)
+            if surplus > 0:
+                self.retiring += surplus
+                self.cond.notify(surplus)
+            self.idle_low = self.idle
+
+    def _next(self):
+        """
+        Wait for a key that is ready to run. Return None if this thread
+        should exit instead.
+        """
+        with self.lock:
+            while not self.ready:
+                if self.retiring:
+                    self.retiring -= 1
+                    self.threads -= 1
+                    return None
+                self.idle += 1
+                # No timeout: Condition.wait polls when given one
+                self.cond.wait()
+                self.idle -= 1
+                self.idle_low = min(self.idle_low, self.idle)
+            return self.ready.popleft()
+
+    def run(self):
+        while True:
+            key = self._next()
+            if key is None:
+                return
+            # Only this thread takes tasks off key's chain until key is
+            # put back on self.ready
+            chain = self.chains[key]
+            func = chain.popleft()
+            try:
+                func()
+            except Exception, e:
+                logging.exception("Worker exception caught")
+            with self.lock:
+                if chain:
+                    # Let other keys' tasks have a turn first
+                    self.ready.append(key)
+                else:
+                    del self.chains[key]
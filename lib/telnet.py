@@ -31,18 +31,47 @@
 
 BASENAME='vSPC.py'
 
+import collections
+import errno
+import itertools
 import logging
+import socket
+import ssl
 import struct
+import threading
 import time
+import types
 
 from telnetlib import *
 from telnetlib import IAC,DO,DONT,WILL,WONT,BINARY,ECHO,SGA,SB,SE,NOOPT,theNULL
 
+from vSPC.trace import lazy, record
+
 # How long to wait for an option response. Any option response resets
 # the counter. This is mainly to deal with "raw" connections (like
 # gdb) that don't negotiate telnet options at all.
 UNACK_TIMEOUT=0.5
 
+# Characters that FixedTelnet drops from data outside subnegotiations
+CONTROL_DROPPED = theNULL + '\021'
+
+# Most bytes TelnetServer reads from its socket at a time, into its
+# thread's receive buffer; see recv_buffer
+RECV_SIZE=65536
+
+# Most reads TelnetServer.process_available does per call. What is left
+# is reported by the poller again, so a VM that writes without a pause
+# doesn't keep its reader, or the polling thread, to itself.
+MAX_READS=4
+
+# When several chunks are queued to send, up to this many bytes of them
+# are joined and given to a single send()
+SEND_GATHER=65536
+
+# Default send queue water marks; see TelnetServer.send_blocked
+SEND_HIGH_WATER=256*1024
+SEND_LOW_WATER=64*1024
+
 VMWARE_EXT = chr(232) # VMWARE-TELNET-EXT
 
 KNOWN_SUBOPTIONS_1 = chr(0) # + suboptions
@@ -68,6 +97,15 @@ GET_VM_BIOS_UUID = chr(85) # <EOM>
 VM_LOCATION_UUID = chr(86) # + location uuid
 GET_VM_LOCATION_UUID = chr(87) # <EOM>
 
+# NEW-ENVIRON (RFC 1572) subcommands, and the types of what follows them
+ENV_IS = chr(0)
+ENV_SEND = chr(1)
+ENV_INFO = chr(2)
+ENV_VAR = chr(0)
+ENV_VALUE = chr(1)
+ENV_ESC = chr(2)
+ENV_USERVAR = chr(3)
+
 EXT_SUPPORTED = {
     KNOWN_SUBOPTIONS_1 : 'known_options', # VM->Proxy
     KNOWN_SUBOPTIONS_2 : 'known_options_resp', # Proxy->VM
@@ -99,112 +137,328 @@ telnet client. This port is intended for VMware connections only.\r
 def hexdump(data):
     return reduce(lambda x,y: x + ('%x' % ord(y)), data, '')
 
-class FixedTelnet(Telnet):
+def option_codes(opts):
+    """Return opts, options or (command, option) pairs, as numbers."""
+    return [map(ord, o) if isinstance(o, tuple) else ord(o) for o in opts]
+
+def vmware_cmd(s):
+    """Return VMware extension command s as a subnegotiation."""
+    return IAC + SB + VMWARE_EXT + s + IAC + SE
+
+# What VMTelnetServer sends once a VM agrees to VMWARE-TELNET-EXT, and
+# what VMTelnetProxyClient sends once the proxy asks it to, each as a
+# single write
+VMWARE_INITIAL = vmware_cmd(KNOWN_SUBOPTIONS_2 + ''.join(sorted(EXT_SUPPORTED.keys()))) + \
+    vmware_cmd(GET_VM_VC_UUID) + vmware_cmd(GET_VM_NAME)
+VMWARE_PROXY_INITIAL = vmware_cmd(KNOWN_SUBOPTIONS_1 + ''.join(sorted(EXT_SUPPORTED.keys()))) + \
+    vmware_cmd(DO_PROXY + 'S' + BASENAME)
+
+# (server_opts, client_opts) => the WILLs and DOs that a TelnetServer
+# with those options opens negotiation with
+_negotiation_requests = {}
+
+def negotiation_request(server_opts, client_opts):
+    """
+    Return the WILLs for server_opts and the DOs for client_opts, as
+    one string. Connections with the same options share the string.
+    """
+    key = (tuple(server_opts), tuple(client_opts))
+    req = _negotiation_requests.get(key)
+    if req is None:
+        req = ''.join([IAC + WILL + opt for opt in server_opts] +
+                      [IAC + DO + opt for opt in client_opts])
+        _negotiation_requests[key] = req
+    return req
+
+_recv_buffers = threading.local()
+
+def recv_buffer(size):
+    """
+    Return the calling thread's receive buffer, grown to at least size
+    bytes. What is read into it is copied out right away, so a buffer
+    per thread serves every connection read on that thread.
+    """
+    buf = getattr(_recv_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _recv_buffers.buf = bytearray(size)
+    return buf
+
+def escape_iac(s):
+    """Double any IAC in s, so that it is sent as data."""
+    if IAC not in s:
+        return s
+    return s.replace(IAC, IAC + IAC)
+
+def parse_environ(data):
+    """
+    Return the variables in the body of a NEW-ENVIRON IS or INFO
+    subnegotiation as a dict. Variables sent without a value are
+    given as None.
+    """
+    env = {}
+    name = None
+    cur = None
+    esc = False
+    for c in data:
+        if esc:
+            cur.append(c)
+            esc = False
+        elif c in (ENV_VAR, ENV_USERVAR):
+            if name is not None:
+                env[''.join(name)] = ''.join(cur) if cur is not name else None
+            name = cur = []
+        elif c == ENV_VALUE and name is not None:
+            cur = []
+        elif c == ENV_ESC:
+            esc = cur is not None
+        elif cur is not None:
+            cur.append(c)
+    if name is not None:
+        env[''.join(name)] = ''.join(cur) if cur is not name else None
+    return env
+
+class SharedChunk(str):
+    """
+    Output queued by reference on several TelnetServers at once. See
+    SendAccounting.share.
+    """
+
+class SendAccounting:
+    """
+    Keeps count of the SharedChunks waiting in TelnetServer send queues,
+    and of the bytes they hold. A chunk waiting on several queues is
+    counted once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunks = 0
+        self.bytes = 0
+
+    def share(self, s):
+        """
+        Encode s for sending to telnet clients and return it as a
+        SharedChunk, to be given to the send_buffered of each of them.
+        """
+        chunk = SharedChunk(escape_iac(s))
+        chunk.accounting = self
+        # Number of send queues holding the chunk
+        chunk.refs = 0
+        return chunk
+
+    def hold(self, chunk):
+        with self.lock:
+            chunk.refs += 1
+            if chunk.refs == 1:
+                self.chunks += 1
+                self.bytes += len(chunk)
+
+    def release(self, chunk):
+        with self.lock:
+            chunk.refs -= 1
+            if not chunk.refs:
+                self.chunks -= 1
+                self.bytes -= len(chunk)
+
+class FixedTelnet(object):
     '''
     FixedTelnet is a bug-fix override of the base Telnet class. In
     particular, base Telnet does not properly handle NULL characters,
     and in general is a little sloppy for BINARY mode.
 
+    Telnet is an old-style class, and classes derived from one always
+    give their instances a __dict__. FixedTelnet is a new-style class
+    that takes on Telnet's methods instead (see below), so that the
+    telnet servers, of which there is one per VM and client connection,
+    can be slotted. It leaves out Telnet.__del__, which made a stream
+    whose option callback is one of its own methods uncollectable.
+
     LICENSING: The code for this class was based on the base Telnet
     class definition from Python 2.6, and as such is covered by that
     GPLv2 compatible license:
     http://www.python.org/download/releases/2.6/license/
     '''
+    # What Telnet.__init__ sets
+    __slots__ = ('debuglevel', 'host', 'port', 'timeout', 'sock', 'rawq', 'irawq',
+                 'cookedq', 'eof', 'iacseq', 'sb', 'sbdataq', 'option_callback',
+                 '_has_poll')
+
     def process_rawq(self):
         """Transfer from raw queue to cooked queue.
 
         Set self.eof when connection is closed.  Don't block unless in
         the midst of an IAC sequence.
 
-        XXX - Sigh, this is a cut and paste from telnetlib to fix a
-        bug in the processing of NULL suring an SB..SE sequence. -ZML
+        Based on telnetlib's, but fixes the processing of NULL during
+        an SB..SE sequence, and works through the raw queue a run of
+        data at a time rather than a character at a time: data is
+        copied up to the next IAC with one slice, and data without any
+        IAC at all goes straight to the cooked queue.
         """
-        buf = ['', '']
-        try:
-            while self.rawq:
-                c = self.rawq_getchar()
-                if not self.iacseq:
-                    if self.sb == 0 and c == theNULL:
-                        continue
-                    if self.sb == 0 and c == "\021":
-                        continue
-                    if c != IAC:
-                        buf[self.sb] = buf[self.sb] + c
-                        continue
+        rawq = self.rawq
+        if self.irawq:
+            rawq = rawq[self.irawq:]
+        self.rawq = ''
+        self.irawq = 0
+        if not rawq:
+            return
+
+        if not self.iacseq and not self.sb and IAC not in rawq:
+            # Console output, the common case. Unless something has to
+            # be dropped from it, rawq becomes (or is added to) the
+            # cooked queue as it is, without being copied.
+            if theNULL in rawq or '\021' in rawq:
+                rawq = rawq.translate(None, CONTROL_DROPPED)
+            self.cookedq = self.cookedq + rawq
+            return
+
+        # Data for the cooked queue, and subnegotiation data
+        buf = ([], [])
+        i = 0
+        end = len(rawq)
+        while i < end:
+            if not self.iacseq:
+                j = rawq.find(IAC, i)
+                if j < 0:
+                    j = end
+                if j > i:
+                    if self.sb == 0:
+                        buf[0].append(rawq[i:j].translate(None, CONTROL_DROPPED))
+                    else:
+                        buf[1].append(rawq[i:j])
+                if j < end:
+                    self.iacseq = IAC
+                i = j + 1
+                continue
+
+            c = rawq[i]
+            i += 1
+            if len(self.iacseq) == 1:
+                # 'IAC: IAC CMD [OPTION only for WILL/WONT/DO/DONT]'
+                if c in (DO, DONT, WILL, WONT):
+                    self.iacseq += c
+                    continue
+
+                self.iacseq = ''
+                if c == IAC:
+                    buf[self.sb].append(c)
+                else:
+                    if c == SB: # SB ... SE start.
+                        self.sb = 1
+                        self.sbdataq = ''
+                    elif c == SE:
+                        self.sb = 0
+                        self.sbdataq = self.sbdataq + ''.join(buf[1])
+                        del buf[1][:]
+                    if self.option_callback:
+                        # Callback is supposed to look into
+                        # the sbdataq
+                        self.option_callback(self.sock, c, NOOPT)
                     else:
-                        self.iacseq += c
-                elif len(self.iacseq) == 1:
-                    # 'IAC: IAC CMD [OPTION only for WILL/WONT/DO/DONT]'
-                    if c in (DO, DONT, WILL, WONT):
-                        self.iacseq += c
-                        continue
-
-                    self.iacseq = ''
-                    if c == IAC:
-                        buf[self.sb] = buf[self.sb] + c
+                        # We can't offer automatic processing of
+                        # suboptions. Alas, we should not get any
+                        # unless we did a WILL/DO before.
+                        self.msg('IAC %d not recognized', ord(c))
+            else:
+                cmd = self.iacseq[1]
+                self.iacseq = ''
+                opt = c
+                if cmd in (DO, DONT):
+                    self.msg('IAC %s %d',
+                        cmd == DO and 'DO' or 'DONT', ord(opt))
+                    if self.option_callback:
+                        self.option_callback(self.sock, cmd, opt)
                     else:
-                        if c == SB: # SB ... SE start.
-                            self.sb = 1
-                            self.sbdataq = ''
-                        elif c == SE:
-                            self.sb = 0
-                            self.sbdataq = self.sbdataq + buf[1]
-                            buf[1] = ''
-                        if self.option_callback:
-                            # Callback is supposed to look into
-                            # the sbdataq
-                            self.option_callback(self.sock, c, NOOPT)
-                        else:
-                            # We can't offer automatic processing of
-                            # suboptions. Alas, we should not get any
-                            # unless we did a WILL/DO before.
-                            self.msg('IAC %d not recognized' % ord(c))
-                elif len(self.iacseq) == 2:
-                    cmd = self.iacseq[1]
-                    self.iacseq = ''
-                    opt = c
-                    if cmd in (DO, DONT):
-                        self.msg('IAC %s %d',
-                            cmd == DO and 'DO' or 'DONT', ord(opt))
-                        if self.option_callback:
-                            self.option_callback(self.sock, cmd, opt)
-                        else:
-                            self.sock.sendall(IAC + WONT + opt)
-                    elif cmd in (WILL, WONT):
-                        self.msg('IAC %s %d',
-                            cmd == WILL and 'WILL' or 'WONT', ord(opt))
-                        if self.option_callback:
-                            self.option_callback(self.sock, cmd, opt)
-                        else:
-                            self.sock.sendall(IAC + DONT + opt)
-        except EOFError: # raised by self.rawq_getchar()
-            self.iacseq = '' # Reset on EOF
-            self.sb = 0
-            pass
-        self.cookedq = self.cookedq + buf[0]
-        self.sbdataq = self.sbdataq + buf[1]
+                        self.sock.sendall(IAC + WONT + opt)
+                elif cmd in (WILL, WONT):
+                    self.msg('IAC %s %d',
+                        cmd == WILL and 'WILL' or 'WONT', ord(opt))
+                    if self.option_callback:
+                        self.option_callback(self.sock, cmd, opt)
+                    else:
+                        self.sock.sendall(IAC + DONT + opt)
+        self.cookedq = self.cookedq + ''.join(buf[0])
+        self.sbdataq = self.sbdataq + ''.join(buf[1])
+
+# The rest of Telnet's methods, but for __del__; see FixedTelnet
+for (_name, _method) in vars(Telnet).items():
+    if isinstance(_method, types.FunctionType) and _name != '__del__' and \
+       _name not in vars(FixedTelnet):
+        setattr(FixedTelnet, _name, _method)
+del _name, _method
+
+# TelnetServer.send_queue until something has to be queued; most
+# connections never have to queue anything
+NO_SEND_QUEUE = ()
 
 class TelnetServer(FixedTelnet):
-    def __init__(self, sock, server_opts = (), client_opts = ()):
-        Telnet.__init__(self)
+    __slots__ = ('server_opts', 'server_opts_accepted', 'client_opts', 'client_opts_accepted',
+                 'unacked', 'last_ack', 'send_queue', 'send_offset', 'send_queued',
+                 'send_high_water', 'send_low_water', 'send_blocked', 'recv_size',
+                 'negotiation_timer', 'inline', 'task_key', 'events')
+
+    # Negotiations given up on by the telnet servers of this process
+    negotiation_timeouts = 0
+
+    def __init__(self, sock, server_opts = (), client_opts = (), negotiate = True):
+        FixedTelnet.__init__(self)
         self.set_option_negotiation_callback(self._option_callback)
         self.sock = sock
-        self.server_opts = list(server_opts) # What do WE do?
-        self.server_opts_accepted = list(server_opts)
-        self.client_opts = list(client_opts) # What do THEY do?
-        self.client_opts_accepted = list(client_opts)
+        # Options are kept in tuples, which are shared with the caller's
+        # when it passed tuples
+        self.server_opts = tuple(server_opts) # What do WE do?
+        self.server_opts_accepted = self.server_opts
+        self.client_opts = tuple(client_opts) # What do THEY do?
+        self.client_opts_accepted = self.client_opts
         self.unacked = []
         self.last_ack = time.time()
-        self.send_buffer = ''
+        # Chunks waiting to be sent, and how much of the first one
+        # was already sent. Chunks are queued as given, not copied, so
+        # a SharedChunk can wait on several queues at once.
+        self.send_queue = NO_SEND_QUEUE
+        self.send_offset = 0
+        # Bytes waiting in send_queue
+        self.send_queued = 0
+        # Set once send_high_water bytes are waiting, and cleared once
+        # no more than send_low_water are; producers feeding this
+        # stream should hold off while it is set
+        self.send_high_water = SEND_HIGH_WATER
+        self.send_low_water = SEND_LOW_WATER
+        self.send_blocked = False
+        # Most bytes to read at a time; see fill_rawq
+        self.recv_size = RECV_SIZE
+        # Timer used by the server to notice negotiation timeouts
+        self.negotiation_timer = None
+        # Set by the server once it handles this stream's reads on the
+        # reactor thread rather than on its task queue
+        self.inline = False
+        # What the server keeps this stream's tasks in order by, if not
+        # by the stream itself
+        self.task_key = None
+        # Ring of recent events, if the server keeps one; see trace
+        self.events = None
+
+        if not negotiate:
+            # Negotiation already happened elsewhere (e.g. in another
+            # vSPC worker that handed us this connection).
+            return
+
+        # All of the WILLs and DOs go out in one write, so that a storm
+        # of new connections costs one send each
+        logging.debug("sending WILL %s, DO %s", lazy(option_codes, self.server_opts),
+                      lazy(option_codes, self.client_opts))
+        self.sock.sendall(negotiation_request(self.server_opts, self.client_opts))
+        self.unacked.extend([(WILL, opt) for opt in self.server_opts])
+        self.unacked.extend([(DO, opt) for opt in self.client_opts])
 
-        for opt in self.server_opts:
-            logging.debug("sending WILL %d" % ord(opt))
-            self._send_cmd(WILL + opt)
-            self.unacked.append((WILL, opt))
-        for opt in self.client_opts:
-            logging.debug("sending DO %d" % ord(opt))
-            self._send_cmd(DO + opt)
-            self.unacked.append((DO, opt))
+    def trace(self, msg, *args):
+        """
+        Log msg % args at DEBUG, and record it in the stream's ring of
+        recent events if it has one. msg is only formatted if it is
+        logged, or once the ring is dumped.
+        """
+        if self.events is not None:
+            record(self.events, msg, args)
+        logging.debug(msg, *args)
 
     def _send_cmd(self, s):
         self.sock.sendall(IAC + s)
@@ -212,7 +466,7 @@ class TelnetServer(FixedTelnet):
     def _option_callback(self, sock, cmd, opt):
         if cmd in (DO, DONT):
             if opt not in self.server_opts:
-                logging.debug("client wants us to %d, sending WONT" % ord(opt))
+                self.trace("client wants us to %d, sending WONT", ord(opt))
                 self._send_cmd(WONT + opt)
                 return
 
@@ -223,20 +477,18 @@ class TelnetServer(FixedTelnet):
                 self.unacked.remove((WILL, opt))
 
             if cmd == DONT:
-                logging.debug("client doesn't want us to %d" % ord(opt))
-                try:
-                    self.server_opts_accepted.remove(opt)
-                except ValueError:
-                    pass
+                self.trace("client doesn't want us to %d", ord(opt))
+                self.server_opts_accepted = tuple(o for o in self.server_opts_accepted
+                                                  if o != opt)
             else:
-                logging.debug("client says we should %d" % ord(opt))
+                self.trace("client says we should %d", ord(opt))
 
             if not msg_is_reply:
                 # Remind client that we want this option
                 self._send_cmd(WILL + opt)
         elif cmd in (WILL, WONT):
             if opt not in self.client_opts:
-                logging.debug("client wants to %d, sending DONT" % ord(opt))
+                self.trace("client wants to %d, sending DONT", ord(opt))
                 self._send_cmd(DONT + opt)
                 return
 
@@ -247,13 +499,11 @@ class TelnetServer(FixedTelnet):
                 self.unacked.remove((DO, opt))
 
             if cmd == WONT:
-                logging.debug("client won't %d" % ord(opt))
-                try:
-                    self.client_opts_accepted.remove(opt)
-                except ValueError:
-                    pass
+                self.trace("client won't %d", ord(opt))
+                self.client_opts_accepted = tuple(o for o in self.client_opts_accepted
+                                                  if o != opt)
             else:
-                logging.debug("client will %d" % ord(opt))
+                self.trace("client will %d", ord(opt))
 
             if not msg_is_reply:
                 # Remind client that we want this option
@@ -261,26 +511,87 @@ class TelnetServer(FixedTelnet):
         elif cmd == SB:
             pass # Don't log this, caller is processing
         else:
-            logging.debug("cmd %d %s" % (ord(cmd), opt))
+            self.trace("cmd %d %r", ord(cmd), opt)
+
+    def fill_rawq(self):
+        """Read into the raw queue whatever the socket has, up to
+        recv_size bytes. Set self.eof when connection is closed.
+
+        telnetlib reads 50 bytes at a time; this reads into the
+        thread's receive buffer with a single recv_into.
+        """
+        if self.irawq >= len(self.rawq):
+            self.rawq = ''
+            self.irawq = 0
+        self.rawq = self.rawq + self.recv_some()
+
+    def recv_some(self):
+        """Return whatever the socket has, up to recv_size bytes. Set
+        self.eof when connection is closed."""
+        buf = recv_buffer(self.recv_size)
+        n = self.sock.recv_into(buf, self.recv_size)
+        self.eof = (not n)
+        return memoryview(buf)[:n].tobytes()
 
     def process_available(self):
-        """Process all data, but don't take anything off the cooked queue.
-        Do not block. Use for buffering data during options negotation.
+        """Process available data, but don't take anything off the cooked
+        queue. Do not block. Use for buffering data during options
+        negotation.
+
+        The socket is read until it has nothing more (EAGAIN), or
+        MAX_READS times, rather than asking select() whether it has
+        anything first as telnetlib does: that costs a system call per
+        read, and select() can't handle file descriptors past
+        FD_SETSIZE (1024). Data a TLS socket has decrypted already is
+        always read, as the poller can't see it.
+
+        What is read is joined and processed once, so that the cooked
+        queue is added to once per call rather than once per read.
         """
         self.process_rawq()
-        while not self.eof and self.sock_avail():
-            self.fill_rawq()
+        timeout = self.sock.gettimeout()
+        if timeout != 0.0:
+            # vSPC's own sockets are non-blocking; those of the command
+            # line tools are made so while we read
+            self.sock.setblocking(0)
+        pending = getattr(self.sock, 'pending', None)
+        reads = 0
+        chunks = []
+        try:
+            while not self.eof:
+                if reads >= MAX_READS and not (pending and pending()):
+                    break
+                reads += 1
+                try:
+                    chunk = self.recv_some()
+                except ssl.SSLError, e:
+                    # Nothing more, or only part of a TLS record, has
+                    # arrived
+                    if e.args[0] not in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                        raise
+                    break
+                except socket.error, e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    break
+                if chunk:
+                    chunks.append(chunk)
+        finally:
+            if timeout != 0.0:
+                self.sock.settimeout(timeout)
+        if chunks:
+            self.rawq = ''.join(chunks)
             self.process_rawq()
 
     def negotiation_done(self):
         self.process_available()
         if self.unacked:
-            desc = map(lambda (x,y): (ord(x), ord(y)), self.unacked)
             if time.time() > self.last_ack + UNACK_TIMEOUT:
-                logging.debug("timeout waiting for commands %s" % desc)
+                self.trace("timeout waiting for commands %s", lazy(option_codes, self.unacked))
+                TelnetServer.negotiation_timeouts += 1
                 self.unacked = []
             else:
-                logging.debug("still waiting for %s" % desc)
+                logging.debug("still waiting for %s", lazy(option_codes, self.unacked))
 
         return not self.unacked
 
@@ -289,11 +600,108 @@ class TelnetServer(FixedTelnet):
             return ''
         return self.read_very_lazy()
 
+    def set_water_marks(self, high, low):
+        assert low <= high
+        self.send_high_water = high
+        self.send_low_water = low
+
     def send_buffered(self, s = ''):
-        self.send_buffer += s
-        nbytes = self.sock.send(self.send_buffer)
-        self.send_buffer = self.send_buffer[nbytes:]
-        return len(self.send_buffer) > 0
+        """
+        Queue s, then send as much of the queue as the socket takes.
+        Return True if anything is left to send.
+        """
+        if s:
+            if isinstance(s, SharedChunk):
+                s.accounting.hold(s)
+            if self.send_queue is NO_SEND_QUEUE:
+                self.send_queue = collections.deque()
+            self.send_queue.append(s)
+            self.send_queued += len(s)
+
+        while self.send_queue:
+            data = self._next_send()
+            try:
+                nbytes = self.sock.send(data)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self._sent(nbytes)
+            if nbytes < len(data):
+                # Socket buffer is full
+                break
+
+        if self.send_queued >= self.send_high_water:
+            self.send_blocked = True
+        elif self.send_queued <= self.send_low_water:
+            self.send_blocked = False
+        return self.send_queued > 0
+
+    def _next_send(self):
+        """
+        Return what to give the next send(): the rest of the first
+        queued chunk, joined with those after it if it is small.
+        """
+        head = self.send_queue[0]
+        if len(self.send_queue) == 1 or len(head) - self.send_offset >= SEND_GATHER:
+            return buffer(head, self.send_offset)
+
+        pieces = [head[self.send_offset:]]
+        size = len(pieces[0])
+        for chunk in itertools.islice(self.send_queue, 1, None):
+            if size >= SEND_GATHER:
+                break
+            pieces.append(chunk)
+            size += len(chunk)
+        return ''.join(pieces)
+
+    def _sent(self, nbytes):
+        """Take nbytes off the front of the send queue."""
+        self.send_queued -= nbytes
+        nbytes += self.send_offset
+        while self.send_queue and nbytes >= len(self.send_queue[0]):
+            chunk = self.send_queue.popleft()
+            nbytes -= len(chunk)
+            if isinstance(chunk, SharedChunk):
+                chunk.accounting.release(chunk)
+        self.send_offset = nbytes
+
+    def drop_oldest(self):
+        """
+        Forget the oldest queued chunks, except one already partly
+        sent, until no more than send_low_water bytes are left to send.
+        Return the number of bytes forgotten.
+        """
+        head = None
+        if self.send_offset:
+            head = self.send_queue.popleft()
+        dropped = 0
+        while self.send_queue and self.send_queued > self.send_low_water:
+            chunk = self.send_queue.popleft()
+            self.send_queued -= len(chunk)
+            dropped += len(chunk)
+            if isinstance(chunk, SharedChunk):
+                chunk.accounting.release(chunk)
+        if head is not None:
+            self.send_queue.appendleft(head)
+
+        if self.send_queued <= self.send_low_water:
+            self.send_blocked = False
+        return dropped
+
+    def drop_send_queue(self):
+        """Forget whatever is left to send."""
+        while self.send_queue:
+            chunk = self.send_queue.popleft()
+            if isinstance(chunk, SharedChunk):
+                chunk.accounting.release(chunk)
+        self.send_offset = 0
+        self.send_queued = 0
+        self.send_blocked = False
+
+    def close(self):
+        self.drop_send_queue()
+        FixedTelnet.close(self)
 
 class VMExtHandler:
     def handle_vmotion_begin(self, ts, data):
@@ -314,51 +722,55 @@ class VMExtHandler:
     def handle_vm_name(self, ts):
         pass
 
+DEFAULT_VMEXT_HANDLER = VMExtHandler()
+
 class VMTelnetServer(TelnetServer):
+    __slots__ = ('handler', 'name', 'uuid')
+
     def __init__(self, sock,
                  server_opts = (BINARY, SGA, ECHO),
                  client_opts = (BINARY, SGA, VMWARE_EXT),
-                 handler = None):
-        TelnetServer.__init__(self, sock, server_opts, client_opts)
-        self.handler = handler or VMExtHandler()
+                 handler = None, negotiate = True):
+        TelnetServer.__init__(self, sock, server_opts, client_opts, negotiate)
+        self.handler = handler or DEFAULT_VMEXT_HANDLER
         self.name = None
         self.uuid = None
 
     def _send_vmware(self, s):
-        self.sock.sendall(IAC + SB + VMWARE_EXT + s + IAC + SE)
+        self.sock.sendall(vmware_cmd(s))
 
     def _handle_known_options(self, data):
-        logging.debug("client knows VM commands: %s" % map(ord, data))
+        self.trace("client knows VM commands: %s", lazy(option_codes, data))
 
     def _handle_unknown_option(self, data):
-        logging.debug("client doesn't know VM command %d, dropping" % hexdump(data))
+        self.trace("client doesn't know VM command %s, dropping", lazy(hexdump, data))
 
     def _handle_do_proxy(self, data):
         dir = 'client' if data[:1] == "C" else 'server'
         uri = data[1:]
-        logging.debug("client wants to proxy %s to %s" % (dir, uri))
+        self.trace("client wants to proxy %s to %s", dir, uri)
         if dir == 'server' and uri == BASENAME:
             self._send_vmware(WILL_PROXY)
         else:
             self._send_vmware(WONT_PROXY)
 
     def _handle_vmotion_begin(self, data):
-        cookie = data + struct.pack("i", hash(self) & 0xFFFFFFFF)
+        cookie = data + struct.pack("I", hash(self) & 0xFFFFFFFF)
 
         if self.handler.handle_vmotion_begin(self, cookie):
-            logging.debug("vMotion initiated: %s" % hexdump(cookie))
+            self.trace("vMotion initiated: %s", lazy(hexdump, cookie))
             self._send_vmware(VMOTION_GOAHEAD + cookie)
         else:
-            logging.debug("vMotion denied: %s" % hexdump(cookie))
+            self.trace("vMotion denied: %s", lazy(hexdump, cookie))
             self._send_vmware(VMOTION_NOTNOW + cookie)
 
     def _handle_vmotion_peer(self, cookie):
         if self.handler.handle_vmotion_peer(self, cookie):
-            logging.debug("vMotion peer: %s" % hexdump(cookie))
+            self.trace("vMotion peer: %s", lazy(hexdump, cookie))
             self._send_vmware(VMOTION_PEER_OK + cookie)
         else:
             # There's no clear spec on rejecting this
-            logging.debug("vMotion peer rejected: %s" % hexdump(cookie))
+            self.trace("vMotion peer rejected: %s", lazy(hexdump, cookie))
             self._send_vmware(UNKNOWN_SUBOPTION_RCVD_2 + VMOTION_PEER)
 
     def _handle_vmotion_complete(self, data):
@@ -374,7 +786,7 @@ class VMTelnetServer(TelnetServer):
             self.handler.handle_vc_uuid(self)
         elif self.uuid != data:
             logging.warn("conflicting uuids? "
-                         "old: %s, new: %s" % (self.uuid, data))
+                         "old: %s, new: %s", self.uuid, data)
             self.close()
 
     def _handle_vm_name(self, data):
@@ -382,11 +794,8 @@ class VMTelnetServer(TelnetServer):
         self.handler.handle_vm_name(self)
 
     def _send_vmware_initial(self):
-        self._send_vmware(KNOWN_SUBOPTIONS_2 + \
-                              reduce(lambda s,c: s+c,
-                                     sorted(EXT_SUPPORTED.keys())))
-        self._send_vmware(GET_VM_VC_UUID)
-        self._send_vmware(GET_VM_NAME)
+        # KNOWN_SUBOPTIONS_2, GET_VM_VC_UUID and GET_VM_NAME
+        self.sock.sendall(VMWARE_INITIAL)
 
         self.unacked.append((VMWARE_EXT, KNOWN_SUBOPTIONS_1))
         self.unacked.append((VMWARE_EXT, VM_VC_UUID))
@@ -418,11 +827,13 @@ class VMTelnetServer(TelnetServer):
                 self.unacked.remove((VMWARE_EXT, subcmd))
 
         if not handled:
-            logging.debug('VMware command %d (data %s) not handled' \
-                              % (ord(subcmd), hexdump(data)))
+            self.trace('VMware command %d (data %s) not handled', ord(subcmd),
+                       lazy(hexdump, data))
             self._send_vmware(UNKNOWN_SUBOPTION_RCVD_2 + subcmd)
 
 class VMTelnetProxyClient(TelnetServer):
+    __slots__ = ('vm_name', 'vm_uuid')
+
     def __init__(self, sock, vm_name, vm_uuid,
                  server_opts = (BINARY, SGA, VMWARE_EXT),
                  client_opts = (BINARY, SGA, ECHO)):
@@ -432,16 +843,16 @@ class VMTelnetProxyClient(TelnetServer):
         TelnetServer.__init__(self, sock, server_opts, client_opts)
 
     def _send_vmware(self, s):
-        self.sock.sendall(IAC + SB + VMWARE_EXT + s + IAC + SE)
+        self.sock.sendall(vmware_cmd(s))
 
     def _handle_known_options(self, data):
-        logging.debug("client knows VM commands: %s" % map(ord, data))
+        self.trace("client knows VM commands: %s", lazy(option_codes, data))
 
     def _handle_unknown_option(self, data):
-        logging.debug("client doesn't know VM command %d, dropping" % hexdump(data))
+        self.trace("client doesn't know VM command %s, dropping", lazy(hexdump, data))
 
     def _handle_unknown_option_resp(self, data):
-        logging.debug("client doesn't know VM command %s, dropping" % hexdump(data))
+        self.trace("client doesn't know VM command %s, dropping", lazy(hexdump, data))
 
     def _handle_get_vm_name(self, data):
         self._send_vmware(VM_NAME + self.vm_name)
@@ -450,10 +861,10 @@ class VMTelnetProxyClient(TelnetServer):
         self._send_vmware(VM_VC_UUID + self.vm_uuid)
 
     def _handle_do_proxy_will(self, data):
-        logging.debug("proxy will handle proxy request for vm %s (%s)" % (self.vm_name, self.vm_uuid))
+        self.trace("proxy will handle proxy request for vm %s (%s)", self.vm_name, self.vm_uuid)
 
     def _handle_do_proxy_wont(self, data):
-        logging.debug("proxy won't handle proxy request for vm %s (%s)" % (self.vm_name, self.vm_uuid))
+        self.trace("proxy won't handle proxy request for vm %s (%s)", self.vm_name, self.vm_uuid)
         # XXX: Consider more robust error handling here?
         self.close()
 
@@ -464,13 +875,8 @@ class VMTelnetProxyClient(TelnetServer):
         self._send_vmware(DO_PROXY + 'S' + 'vSPC.py')
 
     def _send_vmware_initial(self):
-        # Send options
-        self._send_vmware(KNOWN_SUBOPTIONS_1 + \
-                              reduce(lambda s,c: s+c,
-                                     sorted(EXT_SUPPORTED.keys())))
-
-        # Send proxy request
-        self._send_do_proxy()
+        # Send options and the proxy request (see _send_do_proxy)
+        self.sock.sendall(VMWARE_PROXY_INITIAL)
         # expect other end to send us KNOWN_SUBOPTIONS_2
         self.unacked.append((VMWARE_EXT, KNOWN_SUBOPTIONS_2))
 
@@ -501,7 +907,7 @@ class VMTelnetProxyClient(TelnetServer):
                 self.unacked.remove((VMWARE_EXT, subcmd))
 
         if not handled:
-            logging.debug('VMware command %d (data %s) not handled' \
-                              % (ord(subcmd), hexdump(data)))
+            self.trace('VMware command %d (data %s) not handled', ord(subcmd),
+                       lazy(hexdump, data))
             self._send_vmware(UNKNOWN_SUBOPTION_RCVD_2 + subcmd)
 
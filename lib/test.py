@@ -10,6 +10,7 @@ import time
 
 from poll import Poller
 from telnet import VMTelnetProxyClient
+from trace import lazy
 from util import prepare_terminal_with_flags, restore_terminal, string_dump, build_flags_ssh
 
 CLIENT_ESCAPE_CHAR = chr(29)
@@ -54,7 +55,7 @@ class FakeVMClient(Poller):
         except (EOFError, IOError, socket.error):
             self.quit()
 
-        logging.debug("got data from proxy: %s\n" % string_dump(s))
+        logging.debug("got data from proxy: %s\n", lazy(string_dump, s))
 
         if not s:
             # Could be option data, or something else that gets eaten by
@@ -78,7 +79,7 @@ class FakeVMClient(Poller):
             post_data = data[loc+1:]
             data = pre_data + self.process_escape_character() + post_data
 
-        logging.debug("got client data %s, sending to proxy" % string_dump(data))
+        logging.debug("got client data %s, sending to proxy", lazy(string_dump, data))
         self.send_buffered(self.tc, data)
 
     def process_escape_character(self):
@@ -107,7 +108,7 @@ class FakeVMClient(Poller):
         return ret
 
     def send_buffered(self, conn, data = ''):
-        logging.debug("sending data to proxy: %s" % string_dump(data))
+        logging.debug("sending data to proxy: %s", lazy(string_dump, data))
         if conn.send_buffered(data):
             self.add_writer(conn, self.send_buffered)
         else:
@@ -0,0 +1,70 @@
+# vSPC/trace.py -- debug tracing that costs next to nothing while off
+
+"""
+Messages are given to logging as a format and its arguments, so they
+are only formatted if DEBUG is enabled; arguments that are expensive to
+compute (hexdumps and the like) are wrapped in lazy, so that they are
+only computed then too.
+
+Connections can also keep a ring of their most recent events, recorded
+whatever the log level and formatted only when the ring is dumped; see
+TelnetServer.trace and vSPC.dump_events.
+"""
+
+import collections
+import logging
+import time
+
+def debug_enabled():
+    """
+    Return True if DEBUG messages are logged. Use it to guard work done
+    only for the sake of a debug message.
+    """
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+class lazy(object):
+    """
+    A log message argument that is func(*args), computed only if the
+    message is formatted. Format it with %s or %r.
+    """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+    def __repr__(self):
+        return repr(self.func(*self.args))
+
+def event_ring(size):
+    """
+    Return a ring of size events for a connection to record its recent
+    events in, or None if size is 0.
+    """
+    if not size:
+        return None
+    return collections.deque(maxlen = size)
+
+def record(ring, msg, args):
+    """
+    Record msg % args in ring, without formatting it.
+    """
+    ring.append((time.time(), msg, args))
+
+def format_events(ring):
+    """
+    Return the events in ring as lines of text, oldest first.
+    """
+    lines = []
+    # list() copies the ring in one go, while others may add to it
+    for (when, msg, args) in list(ring):
+        try:
+            text = msg % args
+        except Exception, e:
+            text = '%s %r (%s)' % (msg, args, e)
+        lines.append('%s.%03d %s' % (time.strftime('%H:%M:%S', time.localtime(when)),
+                                     int(when * 1000) % 1000, text))
+    return lines
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# Measure how a vSPC server running in this process copes with a storm
+# of VM connections, as when an ESX host comes back and reconnects all
+# of its VMs at once: every fake VM connects at the same moment and
+# sends its whole side of the negotiation without waiting for the
+# server, and we time how long it takes until the server knows all of
+# them by uuid.
+
+import errno
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+from telnetlib import IAC, DO, WILL, SB, SE, BINARY, SGA, ECHO
+
+import vSPC.server as server_module
+from vSPC.backend import vSPCBackendMemory
+from vSPC.server import vSPC, LISTEN_BACKLOG, ACCEPT_BATCH
+from vSPC.telnet import VMWARE_EXT, VM_VC_UUID, VM_NAME
+
+def vm_hello(i):
+    """
+    Return everything fake VM i has to say to get itself registered.
+    """
+    return (IAC + DO + BINARY + IAC + DO + SGA + IAC + DO + ECHO +
+            IAC + WILL + BINARY + IAC + WILL + SGA + IAC + WILL + VMWARE_EXT +
+            IAC + SB + VMWARE_EXT + VM_VC_UUID + 'storm-%d' % i + IAC + SE +
+            IAC + SB + VMWARE_EXT + VM_NAME + 'storm%d' % i + IAC + SE)
+
+def start_server(port, backlog):
+    backend = vSPCBackendMemory()
+    backend.start()
+    server = vSPC(port, port + 1, '127.0.0.1', '127.0.0.1', None,
+                  '127.0.0.1', 3600, backend, listen_backlog = backlog)
+    th = threading.Thread(target = server.run)
+    th.daemon = True
+    th.start()
+    time.sleep(0.3)
+    return server
+
+def storm(server, port, count, timeout):
+    """
+    Connect count fake VMs to port at once. Return the seconds until
+    the server had all of them, or None if it didn't within timeout,
+    and how many it had.
+    """
+    start = time.time()
+    socks = {}
+    for i in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        err = s.connect_ex(('127.0.0.1', port))
+        assert err in (0, errno.EINPROGRESS), errno.errorcode[err]
+        socks[s.fileno()] = (s, vm_hello(i))
+
+    ep = select.epoll()
+    for fd in socks:
+        ep.register(fd, select.EPOLLOUT)
+    waiting = len(socks)
+    end = start + timeout
+    while time.time() < end:
+        if waiting:
+            for (fd, ev) in ep.poll(0.01):
+                ep.unregister(fd)
+                waiting -= 1
+                (s, hello) = socks[fd]
+                if ev & select.EPOLLOUT and not s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    s.send(hello)
+        else:
+            time.sleep(0.01)
+        if len(server.vms) == count:
+            return (time.time() - start, count, socks)
+    return (None, len(server.vms), socks)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", "--port", type='int', default=13370,
+                      help="First of the ports to use (default 13370)")
+    parser.add_option("-n", "--vms", type='int', default=300,
+                      help="Number of VMs connecting at once (default 300)")
+    parser.add_option("-b", "--backlog", type='int', default=LISTEN_BACKLOG,
+                      help="Listen backlog of the batched run (default %d)" % LISTEN_BACKLOG)
+    parser.add_option("-t", "--timeout", type='float', default=30,
+                      help="Seconds to wait for all VMs to register (default 30)")
+    (options, args) = parser.parse_args()
+
+    # The first run is how the server used to accept: a backlog of 5
+    # and one connection per poll wakeup
+    modes = (("backlog 5, one accept per wakeup", 5, 1),
+             ("backlog %d, batched accept" % options.backlog, options.backlog, ACCEPT_BATCH))
+    for (n, (name, backlog, batch)) in enumerate(modes):
+        server_module.ACCEPT_BATCH = batch
+        port = options.port + n * 10
+        server = start_server(port, backlog)
+        (secs, done, socks) = storm(server, port, options.vms, options.timeout)
+        if secs is None:
+            print "%-36s %d of %d VMs registered after %.0fs" % (name, done, options.vms,
+                                                                 options.timeout)
+        else:
+            print "%-36s %d VMs registered in %.3fs" % (name, done, secs)
+        for (s, hello) in socks.values():
+            s.close()
+
+    # Leave without tearing down the interpreter under the servers'
+    # threads, which are still busy with the connections just closed
+    sys.stdout.flush()
+    os._exit(0)
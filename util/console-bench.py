@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# Measure console throughput and keystroke echo latency through a vSPC
+# server running in this process: a fake VM connects to the proxy port
+# and streams data to a number of clients attached to its port, then
+# one client types characters that the VM echoes back.
+
+import socket
+import threading
+import time
+
+from optparse import OptionParser
+from telnetlib import BINARY, SGA, ECHO
+
+from vSPC.backend import vSPCBackendMemory
+from vSPC.server import vSPC
+from vSPC.telnet import TelnetServer, VMTelnetProxyClient
+
+def read_some(ts, timeout = 0.05):
+    """
+    Return whatever data ts has for us within timeout seconds.
+    """
+    ts.sock.settimeout(timeout)
+    try:
+        ts.negotiation_done()
+        return ts.read_very_lazy()
+    except socket.timeout:
+        return ''
+
+def settle(ts, secs):
+    end = time.time() + secs
+    while time.time() < end:
+        read_some(ts)
+
+def send_all(ts, s):
+    ts.sock.settimeout(None)
+    ts.send_buffered(s)
+    while ts.send_queue:
+        ts.send_buffered()
+
+class CountingBackend(vSPCBackendMemory):
+    def __init__(self):
+        vSPCBackendMemory.__init__(self)
+        self.vm_msgs = 0
+
+    def notify_vm_msg(self, uuid, name, s):
+        # Called from the task threads; close enough for a count
+        self.vm_msgs += 1
+
+def start_server(port, kwargs):
+    backend = CountingBackend()
+    backend.start()
+    server = vSPC(port, port + 1, '127.0.0.1', '127.0.0.1', port + 2,
+                  '127.0.0.1', 3600, backend, **kwargs)
+    th = threading.Thread(target = server.run)
+    th.daemon = True
+    th.start()
+    time.sleep(0.3)
+    return server
+
+def connect(port, nclients):
+    vm = VMTelnetProxyClient(socket.create_connection(('127.0.0.1', port)),
+                             'bench', 'bench-uuid')
+    settle(vm, 0.7)
+    clients = []
+    for i in range(nclients):
+        sock = socket.create_connection(('127.0.0.1', port + 2))
+        clients.append(TelnetServer(sock, (BINARY, SGA), (BINARY, SGA, ECHO)))
+    for cl in clients:
+        settle(cl, 0.7)
+    settle(vm, 0.2)
+    return (vm, clients)
+
+def bench_throughput(vm, clients, total, chunk, interval):
+    # Avoid IAC, so that the byte count going in is the count coming out
+    data = 'x' * chunk
+    received = [0] * len(clients)
+
+    def reader(i):
+        while received[i] < total:
+            received[i] += len(read_some(clients[i], 1.0))
+
+    threads = [threading.Thread(target = reader, args = (i,))
+               for i in range(len(clients))]
+    start = time.time()
+    for th in threads:
+        th.start()
+    sent = 0
+    while sent < total:
+        send_all(vm, data)
+        sent += chunk
+        if interval:
+            time.sleep(interval)
+    for th in threads:
+        th.join()
+    return total / (time.time() - start)
+
+def bench_echo(vm, client, count):
+    times = []
+    for i in range(count):
+        start = time.time()
+        send_all(client, 'k')
+        got = ''
+        while not got:
+            got = read_some(vm, 1.0)
+        send_all(vm, got)
+        got = ''
+        while not got:
+            got = read_some(client, 1.0)
+        times.append(time.time() - start)
+    times.sort()
+    return (times[len(times) // 2], times[int(len(times) * 0.99)])
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", "--port", type='int', default=13370,
+                      help="First of the ports to use (default 13370)")
+    parser.add_option("-c", "--clients", type='int', default=2,
+                      help="Number of clients attached to the VM (default 2)")
+    parser.add_option("-b", "--bytes", type='int', default=1024 * 1024,
+                      help="Bytes sent by the VM (default 1MB)")
+    parser.add_option("-s", "--chunk", type='int', default=4096,
+                      help="Size of the VM's writes (default 4096)")
+    parser.add_option("-i", "--interval", type='float', default=0,
+                      help="Milliseconds between the VM's writes, to act like a slow "
+                           "serial port (default 0)")
+    parser.add_option("-e", "--echoes", type='int', default=500,
+                      help="Keystrokes to echo (default 500)")
+    parser.add_option("--coalesce-delay", type='float', default=0,
+                      help="Run the server with this --coalesce-delay, in ms")
+    parser.add_option("--edge-triggered", action='store_true', default=False,
+                      help="Run the server with edge triggered epoll")
+    (options, args) = parser.parse_args()
+
+    modes = (("task queue", {}), ("inline", {'inline_data': True}))
+    for (n, (name, kwargs)) in enumerate(modes):
+        kwargs['edge_triggered'] = options.edge_triggered
+        kwargs['coalesce_delay'] = options.coalesce_delay / 1000.0
+        port = options.port + n * 10
+        server = start_server(port, kwargs)
+        (vm, clients) = connect(port, options.clients)
+        rate = bench_throughput(vm, clients, options.bytes, options.chunk,
+                               options.interval / 1000.0)
+        msgs = server.backend.vm_msgs
+        (median, p99) = bench_echo(vm, clients[0], options.echoes)
+        print "%-10s %8.0f kB/s to each of %d clients in %d backend messages, " \
+            "echo %.0fus median, %.0fus p99" % (name, rate / 1e3, len(clients), msgs,
+                                                median * 1e6, p99 * 1e6)
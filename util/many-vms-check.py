@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Check that a vSPC server running in this process serves more VMs than
+# select() can handle: connect a few thousand fake VMs, wait for the
+# server to know all of them, then pass console data both ways between
+# clients and some of the last VMs, whose sockets are numbered well past
+# FD_SETSIZE (1024).
+
+import errno
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+from telnetlib import IAC, DO, WILL, SB, SE, BINARY, SGA, ECHO
+
+from vSPC.backend import vSPCBackendMemory
+from vSPC.server import vSPC, ROUTE_PROMPT
+from vSPC.telnet import VMWARE_EXT, VM_VC_UUID, VM_NAME
+
+def vm_hello(i):
+    """
+    Return everything fake VM i has to say to get itself registered.
+    """
+    return (IAC + DO + BINARY + IAC + DO + SGA + IAC + DO + ECHO +
+            IAC + WILL + BINARY + IAC + WILL + SGA + IAC + WILL + VMWARE_EXT +
+            IAC + SB + VMWARE_EXT + VM_VC_UUID + 'many-%d' % i + IAC + SE +
+            IAC + SB + VMWARE_EXT + VM_NAME + 'many%d' % i + IAC + SE)
+
+def start_server(port):
+    backend = vSPCBackendMemory()
+    backend.start()
+    # No port per VM; clients reach VMs through the client port
+    server = vSPC(port, port + 1, '127.0.0.1', '127.0.0.1', None,
+                  '127.0.0.1', 3600, backend, client_port = port + 2)
+    th = threading.Thread(target = server.run)
+    th.daemon = True
+    th.start()
+    time.sleep(0.3)
+    return server
+
+def read_until(sock, want, timeout = 5):
+    """
+    Read from sock until want turns up. Return what was read, or None if
+    it didn't turn up within timeout seconds.
+    """
+    sock.settimeout(0.1)
+    got = ''
+    end = time.time() + timeout
+    while want not in got:
+        if time.time() > end:
+            return None
+        try:
+            s = sock.recv(4096)
+        except socket.timeout:
+            continue
+        if not s:
+            return None
+        got += s
+    return got
+
+def connect_vms(port, count, timeout):
+    vms = []
+    for i in range(count):
+        s = socket.create_connection(('127.0.0.1', port), timeout)
+        s.sendall(vm_hello(i))
+        vms.append(s)
+    return vms
+
+def round_trip(server, port, vm_sock, i):
+    """
+    Attach a client to VM i through the client port, and pass data from
+    the VM to the client and back. Return None if that worked, or what
+    went wrong.
+    """
+    cl = socket.create_connection(('127.0.0.1', port + 2))
+    try:
+        if read_until(cl, ROUTE_PROMPT) is None:
+            return 'no prompt'
+        cl.sendall('many%d\r\n' % i)
+        if read_until(cl, '\r\n') is None:
+            return 'not attached'
+        # Give the server a moment to attach the client
+        time.sleep(0.2)
+        vm_sock.sendall('ping %d' % i)
+        if read_until(cl, 'ping %d' % i) is None:
+            return "client didn't get VM output"
+        # The VM has heard from vSPC since it connected; skip to what
+        # the client types
+        vm_sock.settimeout(0.5)
+        try:
+            while vm_sock.recv(65536):
+                pass
+        except socket.timeout:
+            pass
+        cl.sendall('pong %d' % i)
+        if read_until(vm_sock, 'pong %d' % i) is None:
+            return "VM didn't get client input"
+        return None
+    finally:
+        cl.close()
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", "--port", type='int', default=13370,
+                      help="First of the ports to use (default 13370)")
+    parser.add_option("-n", "--vms", type='int', default=2500,
+                      help="Number of VMs to connect (default 2500)")
+    parser.add_option("-c", "--check", type='int', default=5,
+                      help="Number of the last VMs to pass data to and from (default 5)")
+    parser.add_option("-t", "--timeout", type='float', default=60,
+                      help="Seconds to wait for all VMs to register (default 60)")
+    (options, args) = parser.parse_args()
+
+    # Both ends of every VM connection are in this process
+    want = options.vms * 2 + 100
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < want:
+        if hard != resource.RLIM_INFINITY and hard < want:
+            print "need %d file descriptors, but can only have %d" % (want, hard)
+            sys.exit(1)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+
+    server = start_server(options.port)
+    start = time.time()
+    vms = connect_vms(options.port, options.vms, options.timeout)
+    while len(server.vms) < options.vms and time.time() < start + options.timeout:
+        time.sleep(0.1)
+    if len(server.vms) < options.vms:
+        print "FAILED: only %d of %d VMs registered after %.0fs" % (len(server.vms), options.vms,
+                                                                    options.timeout)
+        os._exit(1)
+    fds = [vt.fileno() for vm in server.vms.values() for vt in vm.vts]
+    print "%d VMs registered in %.2fs, server VM sockets up to fd %d" % (
+        options.vms, time.time() - start, max(fds))
+
+    failed = False
+    for i in range(options.vms - options.check, options.vms):
+        vt = server.vms['many-%d' % i].vts[0]
+        problem = round_trip(server, options.port, vms[i], i)
+        print "VM %d (fd %d): %s" % (i, vt.fileno(), problem or 'ok')
+        failed = failed or problem is not None
+
+    # Leave without tearing down the interpreter under the server's
+    # threads
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# Measure how much memory a vSPC server running in this process needs
+# per idle VM and per attached client: a child process connects a number
+# of fake VMs, then attaches a client to some of them, and we report the
+# growth of our resident set size (and of the number of Python objects)
+# per VM and per client. Keep the VM ports below the kernel's ephemeral
+# port range (net.ipv4.ip_local_port_range), where the child's
+# connections get their ports.
+
+import gc
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+from telnetlib import IAC, DO, WILL, SB, SE, BINARY, SGA, ECHO
+
+from vSPC.backend import vSPCBackendMemory
+from vSPC.server import vSPC
+from vSPC.telnet import VMWARE_EXT, VM_VC_UUID, VM_NAME, UNACK_TIMEOUT
+
+def vm_hello(i):
+    """
+    Return everything fake VM i has to say to get itself registered.
+    """
+    return (IAC + DO + BINARY + IAC + DO + SGA + IAC + DO + ECHO +
+            IAC + WILL + BINARY + IAC + WILL + SGA + IAC + WILL + VMWARE_EXT +
+            IAC + SB + VMWARE_EXT + VM_VC_UUID + 'mem-%d' % i + IAC + SE +
+            IAC + SB + VMWARE_EXT + VM_NAME + 'mem%d' % i + IAC + SE)
+
+def resident():
+    return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+
+def settle(server, secs):
+    """
+    Wait for secs, then for the server to be done with its tasks, and
+    collect garbage.
+    """
+    time.sleep(secs)
+    while server.task_pool.depth():
+        time.sleep(0.1)
+    gc.collect()
+
+def child(port, count, rd, wr):
+    """
+    Once the parent says so, connect count fake VMs to port, then attach
+    a client to each of the VM ports the parent sends us. Report back
+    after each step, and exit once the parent closes the pipe.
+    """
+    f = os.fdopen(rd)
+    f.readline()
+    vms = []
+    for i in range(count):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(vm_hello(i))
+        vms.append(s)
+    os.write(wr, 'vms\n')
+
+    clients = []
+    for port in f.readline().split():
+        clients.append(socket.create_connection(('127.0.0.1', int(port))))
+    os.write(wr, 'clients\n')
+    f.read()
+    os._exit(0)
+
+def wait_for(rd, what):
+    assert os.read(rd, 64) == what + '\n'
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", "--port", type='int', default=13370,
+                      help="First of the ports to use; VM ports start 100 above it "
+                           "(default 13370)")
+    parser.add_option("-n", "--vms", type='int', default=5000,
+                      help="Number of idle VMs (default 5000)")
+    parser.add_option("-c", "--clients", type='int', default=1000,
+                      help="Number of VMs to attach a client to (default 1000)")
+    (options, args) = parser.parse_args()
+
+    # Every VM has a connection, a listener for clients, and maybe a client
+    want = options.vms * 3 + 100
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < want:
+        if hard != resource.RLIM_INFINITY and hard < want:
+            print "need %d file descriptors, but can only have %d" % (want, hard)
+            sys.exit(1)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+
+    (child_rd, to_child) = os.pipe()
+    (from_child, child_wr) = os.pipe()
+    if os.fork() == 0:
+        os.close(to_child)
+        os.close(from_child)
+        child(options.port, options.vms, child_rd, child_wr)
+    os.close(child_rd)
+    os.close(child_wr)
+
+    backend = vSPCBackendMemory()
+    backend.start()
+    server = vSPC(options.port, options.port + 1, '127.0.0.1', '127.0.0.1',
+                  options.port + 100, '127.0.0.1', 3600, backend)
+    th = threading.Thread(target = server.run)
+    th.daemon = True
+    th.start()
+    settle(server, 0.5)
+    base = resident()
+    base_objects = len(gc.get_objects())
+
+    os.write(to_child, 'go\n')
+    wait_for(from_child, 'vms')
+    while len(server.vms) < options.vms:
+        time.sleep(0.1)
+    settle(server, UNACK_TIMEOUT + 0.5)
+    with_vms = resident()
+    vm_objects = len(gc.get_objects())
+    print "%8.0f bytes, %5.1f objects per idle VM" % (
+        float(with_vms - base) / options.vms, float(vm_objects - base_objects) / options.vms)
+
+    ports = sorted(vm.port for vm in server.vms.values())[:options.clients]
+    os.write(to_child, ' '.join(map(str, ports)) + '\n')
+    wait_for(from_child, 'clients')
+    while sum(len(vm.clients) for vm in server.vms.values()) < len(ports):
+        time.sleep(0.1)
+    settle(server, UNACK_TIMEOUT + 0.5)
+    with_clients = resident()
+    client_objects = len(gc.get_objects())
+    print "%8.0f bytes, %5.1f objects per attached client" % (
+        float(with_clients - with_vms) / len(ports),
+        float(client_objects - vm_objects) / len(ports))
+
+    os.close(to_child)
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# Compare the epoll Poller with the asyncio-based AsyncioPoller on the
+# same workload: a number of socket pairs, each bouncing messages back
+# and forth between its two ends, all served by one reactor.
+
+import socket
+import sys
+import time
+
+from optparse import OptionParser
+
+from vSPC.poll import Poller
+
+class PingPong(Poller):
+    def __init__(self, pairs, size):
+        Poller.__init__(self)
+        self.msg = 'x' * size
+        self.count = 0
+        self.socks = []
+        for i in range(pairs):
+            (a, b) = socket.socketpair()
+            a.setblocking(0)
+            b.setblocking(0)
+            self.socks.extend((a, b))
+
+    def start(self):
+        for s in self.socks:
+            self.add_reader(s, self.bounce)
+        for s in self.socks[::2]:
+            s.send(self.msg)
+
+    def bounce(self, s):
+        data = s.recv(65536)
+        self.count += 1
+        s.send(data)
+
+def bench_poller(pairs, size, duration):
+    pp = PingPong(pairs, size)
+    pp.start()
+    end = time.time() + duration
+    while time.time() < end:
+        pp.run_once(0.1)
+    return (pp.count, pp.poll_stats())
+
+def bench_asyncio(pairs, size, duration):
+    from vSPC.asyncpoll import on_asyncio, asyncio
+
+    loop = asyncio.new_event_loop()
+    pp = on_asyncio(PingPong)(pairs, size, loop = loop)
+    pp.start()
+    loop.call_later(duration, loop.stop)
+    pp.run_forever()
+    return (pp.count, None)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-p", "--pairs", type='int', default=500,
+                      help="Number of socket pairs (default 500)")
+    parser.add_option("-s", "--size", type='int', default=64,
+                      help="Message size in bytes (default 64)")
+    parser.add_option("-t", "--time", type='float', default=5.0,
+                      help="Seconds to run each reactor for (default 5)")
+    (options, args) = parser.parse_args()
+
+    for (name, bench) in (("epoll Poller", bench_poller),
+                          ("AsyncioPoller", bench_asyncio)):
+        try:
+            (count, stats) = bench(options.pairs, options.size, options.time)
+        except ImportError, e:
+            print "%-14s skipped (%s)" % (name, e)
+            continue
+        print "%-14s %10.0f messages/s" % (name, count / options.time)
+        if stats and stats['wakeups']:
+            print "%-14s %10.1f events/wakeup, %.1fus handler time/event" % \
+                ('', float(stats['events']) / stats['wakeups'],
+                 stats['handler_time'] * 1e6 / max(stats['events'], 1))
+        sys.stdout.flush()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+# Check FixedTelnet.process_rawq against the character at a time parser
+# it replaced, on random input fed in random pieces, then compare how
+# fast the two turn typical console output into cooked data.
+
+import random
+import time
+
+from optparse import OptionParser
+from telnetlib import Telnet, IAC, DO, DONT, WILL, WONT, SB, SE, NOP, NOOPT, theNULL
+
+from vSPC.telnet import FixedTelnet, VMWARE_EXT
+
+class ReferenceTelnet(Telnet):
+    """
+    FixedTelnet as it was, handling the raw queue a character at a time.
+    """
+    def process_rawq(self):
+        buf = ['', '']
+        try:
+            while self.rawq:
+                c = self.rawq_getchar()
+                if not self.iacseq:
+                    if self.sb == 0 and c == theNULL:
+                        continue
+                    if self.sb == 0 and c == "\021":
+                        continue
+                    if c != IAC:
+                        buf[self.sb] = buf[self.sb] + c
+                        continue
+                    else:
+                        self.iacseq += c
+                elif len(self.iacseq) == 1:
+                    if c in (DO, DONT, WILL, WONT):
+                        self.iacseq += c
+                        continue
+
+                    self.iacseq = ''
+                    if c == IAC:
+                        buf[self.sb] = buf[self.sb] + c
+                    else:
+                        if c == SB:
+                            self.sb = 1
+                            self.sbdataq = ''
+                        elif c == SE:
+                            self.sb = 0
+                            self.sbdataq = self.sbdataq + buf[1]
+                            buf[1] = ''
+                        if self.option_callback:
+                            self.option_callback(self.sock, c, NOOPT)
+                        else:
+                            self.msg('IAC %d not recognized' % ord(c))
+                elif len(self.iacseq) == 2:
+                    cmd = self.iacseq[1]
+                    self.iacseq = ''
+                    opt = c
+                    if cmd in (DO, DONT):
+                        self.msg('IAC %s %d',
+                            cmd == DO and 'DO' or 'DONT', ord(opt))
+                        if self.option_callback:
+                            self.option_callback(self.sock, cmd, opt)
+                        else:
+                            self.sock.sendall(IAC + WONT + opt)
+                    elif cmd in (WILL, WONT):
+                        self.msg('IAC %s %d',
+                            cmd == WILL and 'WILL' or 'WONT', ord(opt))
+                        if self.option_callback:
+                            self.option_callback(self.sock, cmd, opt)
+                        else:
+                            self.sock.sendall(IAC + DONT + opt)
+        except EOFError:
+            self.iacseq = ''
+            self.sb = 0
+            pass
+        self.cookedq = self.cookedq + buf[0]
+        self.sbdataq = self.sbdataq + buf[1]
+
+class Recorder:
+    """
+    Feed a parser, recording what it hands its option callback and what
+    state it is left in after each piece of input.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+        self.log = []
+        parser.set_option_negotiation_callback(self.callback)
+
+    def callback(self, sock, cmd, opt):
+        p = self.parser
+        self.log.append(('callback', cmd, opt, p.sbdataq, p.sb, p.cookedq))
+        # Like vSPC's callbacks, take the subnegotiation data some of
+        # the time
+        if cmd == SE and len(self.log) % 2:
+            self.log.append(('sb data', p.read_sb_data()))
+
+    def feed(self, s):
+        p = self.parser
+        p.rawq = p.rawq + s
+        p.process_rawq()
+        self.log.append(('state', p.cookedq, p.sbdataq, p.sb, p.iacseq, p.rawq, p.irawq))
+
+# Bytes random input is made of, weighted towards those that matter to
+# the parser
+ALPHABET = ([IAC] * 6 + [SB, SE] * 3 + [DO, DONT, WILL, WONT, NOP, VMWARE_EXT] +
+            [theNULL, '\021'] * 2 + list('abc\r\n'))
+
+def check(rounds, seed):
+    rnd = random.Random(seed)
+    for n in range(rounds):
+        data = ''.join(rnd.choice(ALPHABET) for i in range(rnd.randint(0, 200)))
+        pieces = []
+        i = 0
+        while i < len(data):
+            j = i + rnd.randint(1, 20)
+            pieces.append(data[i:j])
+            i = j
+        new = Recorder(FixedTelnet())
+        ref = Recorder(ReferenceTelnet())
+        for s in pieces:
+            new.feed(s)
+            ref.feed(s)
+        if new.log != ref.log:
+            print "MISMATCH on %r in pieces %r" % (data, pieces)
+            for (a, b) in zip(new.log, ref.log):
+                print "  %s %r" % ('  ' if a == b else '!=', a)
+            return False
+    return True
+
+def console_data(total, rnd, iac_every):
+    """
+    Return total bytes of console-like output, with an IAC command every
+    iac_every bytes (or none if iac_every is 0).
+    """
+    line = 'kernel: [    1.234567] eth0: link up, 1000 Mbps, full duplex\r\n'
+    data = (line * (total // len(line) + 1))[:total]
+    if not iac_every:
+        return data
+    out = []
+    for i in range(0, total, iac_every):
+        out.append(data[i:i + iac_every])
+        out.append(rnd.choice((IAC + IAC, IAC + NOP, IAC + WILL + VMWARE_EXT)))
+    return ''.join(out)
+
+def bench(cls, data, chunk):
+    p = cls()
+    p.set_option_negotiation_callback(lambda sock, cmd, opt: None)
+    start = time.time()
+    for i in range(0, len(data), chunk):
+        p.rawq = data[i:i + chunk]
+        p.process_rawq()
+        p.cookedq = ''
+    return len(data) / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-r", "--rounds", type='int', default=20000,
+                      help="Random inputs to compare the parsers on (default 20000)")
+    parser.add_option("--seed", type='int', default=1,
+                      help="Seed for the random inputs (default 1)")
+    parser.add_option("-b", "--bytes", type='int', default=4 * 1024 * 1024,
+                      help="Bytes of console output to parse (default 4MB)")
+    parser.add_option("-s", "--chunk", type='int', default=4096,
+                      help="Bytes given to the parser at a time (default 4096)")
+    (options, args) = parser.parse_args()
+
+    if not check(options.rounds, options.seed):
+        raise SystemExit(1)
+    print "parsers agree on %d random inputs" % options.rounds
+
+    rnd = random.Random(options.seed)
+    for (name, iac_every) in (("no IAC", 0), ("IAC every 4kB", 4096), ("IAC every 64B", 64)):
+        data = console_data(options.bytes, rnd, iac_every)
+        old = bench(ReferenceTelnet, data, options.chunk)
+        new = bench(FixedTelnet, data, options.chunk)
+        print "%-14s old %8.0f kB/s  new %8.0f kB/s  (%.0fx)" % (name, old / 1e3, new / 1e3,
+                                                                new / old)